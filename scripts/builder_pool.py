@@ -0,0 +1,236 @@
+'''
+A pool of warm builder servers shared by the ccbuild runs on this host.
+
+Provisioning a bare-metal builder (lease, server, floating IP) takes far
+longer than most builds, so in pool mode ccbuild hands its builder back
+here instead of deleting its lease. The pool is a JSON file guarded by a
+file lock; each entry is one leased, running builder:
+
+    {"lease_id", "server_id", "ip", "node_type", "builder_image",
+     "lease_end", "state": "idle" | "busy", "owner", "last_used"}
+
+Idle builders are kept per (node_type, builder_image) up to the pool
+size and torn down once idle for too long or when their lease is about
+to end.
+'''
+import contextlib
+import datetime
+import fcntl
+import json
+import os
+import sys
+
+import chi
+from chi import lease as chi_lease
+from chi import server as chi_server
+
+sys.path.append("..")
+from utils import helpers
+
+
+DEFAULT_POOL_FILE = os.path.expanduser("~/.cache/abracadabra/builder-pool.json")
+# never hand out a builder whose lease ends before a build could finish
+LEASE_END_MARGIN = datetime.timedelta(hours=3)
+# busy entries older than this belong to builds that died without releasing
+BUSY_TIMEOUT = datetime.timedelta(hours=24)
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def _now():
+    return datetime.datetime.utcnow()
+
+
+def _parse_time(value):
+    return datetime.datetime.strptime(value[:19], TIME_FORMAT)
+
+
+def provision_builder(name, node_type, builder_image, key_name,
+                      reserve_ip=False, use_lease=None):
+    """
+    Lease a node, launch a builder server on it and give it a floating IP.
+    Returns a pool entry describing the builder.
+    """
+    print("Lease: creating...")
+    if use_lease:
+        lease = chi_lease.get_lease(use_lease)
+    else:
+        reservations = []
+        chi_lease.add_node_reservation(reservations, count=1, node_type=node_type)
+        if reserve_ip:
+            chi_lease.add_fip_reservation(reservations, count=1)
+        lease = chi_lease.create_lease("lease-{}".format(name), reservations)
+        if not lease:
+            raise RuntimeError(
+                "Not enough nodes to satisfy your request! Try again later!"
+            )
+
+    print("Waiting for lease to become active...")
+    helpers.wait_for_lease_active(lease["id"])
+    lease = chi_lease.get_lease(lease["id"])
+    print(" - started {}".format(lease["name"]))
+
+    print("Server: creating...")
+    reservation_id = chi_lease.get_node_reservation(lease["id"])
+    server = chi_server.create_server(
+        "instance-{}".format(name),
+        image_name=builder_image,
+        flavor_name="baremetal",
+        key_name=key_name,
+        reservation_id=reservation_id,
+    )
+
+    print(" - building...")
+    helpers.wait_for_server_active(server.id)
+    print(" - started {}...".format(server.name))
+    if reserve_ip:
+        ip = chi_lease.get_reserved_floating_ips(lease["id"])[0]
+        print(f"Associating IP {ip} to server {server.id}...")
+        chi_server.associate_floating_ip(server.id, ip)
+    else:
+        print(f"Associatign ad-hoc IP to server {server.id}")
+        ip = chi_server.associate_floating_ip(server.id)
+
+    return {
+        "lease_id": lease["id"],
+        "server_id": server.id,
+        "ip": ip,
+        "node_type": node_type,
+        "builder_image": builder_image,
+        "lease_end": lease["end_date"],
+        "state": "busy",
+        "owner": name,
+        "last_used": _now().strftime(TIME_FORMAT),
+    }
+
+
+def teardown_builder(entry):
+    print(f"Tearing down builder {entry['server_id']} (lease {entry['lease_id']})...")
+    helpers.ssh_connections.close(entry["ip"])
+    try:
+        chi_lease.delete_lease(entry["lease_id"])
+    except Exception as e:
+        print(f"failed to delete lease {entry['lease_id']}: {e}", file=sys.stderr)
+
+
+def clean_builder(entry, method="wipe"):
+    """
+    Bring a used builder back to a state fit for the next build, either by
+    wiping the build workspaces or by rebuilding the server from its image.
+    """
+    if method == "rebuild":
+        image_id = chi_server.get_image_id(entry["builder_image"])
+        helpers.ssh_connections.close(entry["ip"])
+        chi.nova().servers.rebuild(entry["server_id"], image_id)
+        helpers.wait_for_server_active(entry["server_id"])
+        chi.server.wait_for_tcp(entry["ip"], port=22)
+    else:
+        helpers.remote_run(
+            ip=entry["ip"],
+            command="sudo rm -rf ~/build ~/build.git ~/build-* /tmp/dib_build.* /tmp/dib_image.*",
+        )
+    out = helpers.remote_run(ip=entry["ip"], command="true")
+    if out.failed:
+        raise RuntimeError(f"builder {entry['server_id']} is unhealthy")
+
+
+class BuilderPool:
+    def __init__(self, path=DEFAULT_POOL_FILE, size=1, idle_ttl_hours=12):
+        self.path = path
+        self.size = size
+        self.idle_ttl = datetime.timedelta(hours=idle_ttl_hours)
+
+    @contextlib.contextmanager
+    def _entries(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            if os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    entries = json.load(f)
+            yield entries
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+    def _is_expired(self, entry, now):
+        if _parse_time(entry["lease_end"]) - now < LEASE_END_MARGIN:
+            return True
+        idle_for = now - _parse_time(entry["last_used"])
+        if entry["state"] == "idle":
+            return idle_for > self.idle_ttl
+        return idle_for > BUSY_TIMEOUT
+
+    def expire(self):
+        """
+        Tear down builders idle past the TTL, abandoned by dead builds or
+        whose lease ends soon.
+        """
+        now = _now()
+        with self._entries() as entries:
+            expired = [e for e in entries if self._is_expired(e, now)]
+            entries[:] = [e for e in entries if e not in expired]
+        for entry in expired:
+            teardown_builder(entry)
+
+    def acquire(self, node_type, builder_image, owner):
+        """
+        Claim an idle builder for node_type and builder_image, or return
+        None if there is none.
+        """
+        now = _now()
+        with self._entries() as entries:
+            for entry in entries:
+                if (
+                    entry["state"] == "idle" and
+                    entry["node_type"] == node_type and
+                    entry["builder_image"] == builder_image and
+                    not self._is_expired(entry, now)
+                ):
+                    entry["state"] = "busy"
+                    entry["owner"] = owner
+                    entry["last_used"] = now.strftime(TIME_FORMAT)
+                    print(f"Using warm builder {entry['server_id']} at {entry['ip']}")
+                    return dict(entry)
+        return None
+
+    def add(self, entry):
+        with self._entries() as entries:
+            entries.append(dict(entry))
+
+    def release(self, entry, clean="wipe", healthy=True):
+        """
+        Return a builder to the pool after cleaning it, or tear it down if
+        it is unhealthy or the pool already has enough idle builders.
+        """
+        if healthy:
+            try:
+                clean_builder(entry, clean)
+            except Exception as e:
+                print(f"failed to clean builder {entry['server_id']}: {e}",
+                      file=sys.stderr)
+                healthy = False
+
+        keep = False
+        with self._entries() as entries:
+            idle = [
+                e for e in entries
+                if e["state"] == "idle" and
+                e["node_type"] == entry["node_type"] and
+                e["builder_image"] == entry["builder_image"]
+            ]
+            for e in entries:
+                if e["server_id"] != entry["server_id"]:
+                    continue
+                if healthy and len(idle) < self.size:
+                    e["state"] = "idle"
+                    e["owner"] = None
+                    e["last_used"] = _now().strftime(TIME_FORMAT)
+                    keep = True
+                else:
+                    entries.remove(e)
+                break
+
+        if not keep:
+            teardown_builder(entry)
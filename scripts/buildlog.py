@@ -0,0 +1,94 @@
+'''
+A streaming sink for remote build output.
+
+Output is appended to the log file as it arrives, so a build can be
+followed with `tail -f` and never sits in memory as a whole. Complete
+lines are matched against marker prefixes on the fly, and only the last
+few lines are kept for error reports.
+
+A log path ending in .gz is written gzip-compressed. With max_bytes set,
+the log is rotated like logging.handlers.RotatingFileHandler does:
+build.log becomes build.log.1, build.log.1 becomes build.log.2 and so on,
+keeping at most `backups` old files.
+'''
+import collections
+import gzip
+import os
+
+# a "line" without a newline this long (progress bars) is cut short
+MAX_LINE_LENGTH = 64 * 1024
+
+
+class BuildLog:
+    def __init__(self, path, markers=None, tail_lines=200, max_bytes=None, backups=3):
+        self.path = path
+        # name -> line prefix; the rest of the first matching line is kept
+        self.markers = dict(markers or {})
+        self.matches = {}
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._tail = collections.deque(maxlen=tail_lines)
+        self._partial = ""
+        self._written = 0
+        self._file = self._open()
+
+    def _open(self):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, "wt")
+        return open(self.path, "w")
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._written = 0
+        self._file = self._open()
+
+    def _line(self, line):
+        line = line.rstrip("\r")
+        self._tail.append(line)
+        for name, prefix in self.markers.items():
+            if name not in self.matches and line.startswith(prefix):
+                self.matches[name] = line[len(prefix):].strip()
+
+    def write(self, data):
+        if self.max_bytes and self._written >= self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._written += len(data)
+        if not self.path.endswith(".gz"):
+            # keep the log followable while the build runs
+            self._file.flush()
+
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._line(line)
+        if len(self._partial) > MAX_LINE_LENGTH:
+            self._line(self._partial)
+            self._partial = ""
+        return len(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._partial:
+            self._line(self._partial)
+            self._partial = ""
+        self._file.close()
+
+    def tail(self):
+        return "\n".join(self._tail)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -6,19 +6,26 @@ import json
 import os
 import sys
 import textwrap
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 
 import chi
 import ulid
-from chi import lease as chi_lease
-from chi import server as chi_server
-from pyaml_env import parse_config
 
+import dibcache
+from builder_pool import (
+    DEFAULT_POOL_FILE,
+    BuilderPool,
+    provision_builder,
+    teardown_builder,
+)
+from buildlog import BuildLog
 from variant_extra_build_steps import ExtraSteps
 
 sys.path.append("..")
-from utils import helpers
+from utils import catalog, helpers, waiter
 
 
 PY3 = sys.version_info.major >= 3
@@ -26,9 +33,30 @@ if not PY3:
     raise RuntimeError("Python 2 not supported.")
 
 BUILD_TAG = os.environ.get("BUILD_TAG", "imgbuild-{}".format(ulid.ulid()))
-
-
-def do_build(ip, rc, repodir, commit, metadata, variant, extra_params):
+IMAGE_BUILT_MARKER = "Image built in "
+CONVERT_COROUTINES = 8
+CENTRAL_SEGMENT_SIZE = 512 * 2**20
+# conversions and uploads of one build's outputs running at once
+UPLOAD_CONCURRENCY = 4
+# under the builder's home; kept when a pooled builder is wiped
+REMOTE_REPOS_DIR = "repos"
+
+_install_locks = {}
+_install_locks_guard = threading.Lock()
+
+
+def _install_lock(ip):
+    with _install_locks_guard:
+        return _install_locks.setdefault(ip, threading.Lock())
+
+
+def do_build(ip, rc, repodir, commit, metadata, variant, extra_params,
+             workspace="build", log_file="build.log", log_max_bytes=None,
+             dib_cache=None):
+    """
+    Build an image on the builder at ip from commit of repodir. The repo is
+    checked out in ~/{workspace} so several builds can share a builder.
+    """
     chi.server.wait_for_tcp(ip, port=22)
     print("remote contactable!")
 
@@ -47,13 +75,17 @@ def do_build(ip, rc, repodir, commit, metadata, variant, extra_params):
         }
         extra_steps(**kwargs)
 
-    # init remote repo
+    # the bare repo is kept between builds on a reused builder, so a push
+    # only sends the objects it is missing
+    remote_repo = f"{REMOTE_REPOS_DIR}/{os.path.basename(os.path.abspath(repodir))}.git"
     # For the first command, retry for 30 minutes until SSH comes online
-    helpers.remote_run(ip=ip, command="rm -rf ~/build.git", retries=360)
-    out = helpers.remote_run(ip=ip, command="git init --bare build.git")
-    print(out)
+    out = helpers.remote_run(
+        ip=ip, command=f"git init -q --bare ~/{remote_repo}", retries=360
+    )
+    if out.failed:
+        raise RuntimeError("creating the remote repo failed")
 
-    print("- pushing repo to remote")
+    print("- pushing commit to remote")
     # GIT_SSH_COMMAND setup (requires Git 2.3.0+, CentOS repos have ~1.8)
     git_ssh_args = ssh_args
 
@@ -61,7 +93,9 @@ def do_build(ip, rc, repodir, commit, metadata, variant, extra_params):
         print("  - using ssh keyfile at: {}".format(ssh_key_file))
         git_ssh_args.append("-i {}".format(ssh_key_file))
     proc = helpers.run(
-        "git push --all ssh://cc@{ip}/~/build.git".format(ip=ip),
+        "git push --force ssh://cc@{ip}/~/{remote_repo} {commit}:refs/builds/{workspace}".format(
+            ip=ip, remote_repo=remote_repo, commit=commit, workspace=workspace
+        ),
         cwd=repodir,
         env={
             "GIT_SSH_COMMAND": "ssh {}".format(" ".join(git_ssh_args)),
@@ -71,54 +105,79 @@ def do_build(ip, rc, repodir, commit, metadata, variant, extra_params):
     if proc.returncode != 0:
         raise RuntimeError("repo push to remote failed")
 
-    # checkout local rev on remote
-    helpers.remote_run(ip=ip, command="rm -rf ~/build")
-    helpers.remote_run(ip=ip, command="git clone ~/build.git ~/build")
-    helpers.remote_run(
+    # checkout local rev on remote, borrowing the bare repo's objects
+    out = helpers.remote_run(
         ip=ip,
-        command="cd /home/cc/build && git -c advice.detachedHead=false checkout {head}".format(
-            head=commit
+        command=(
+            f"rm -rf ~/{workspace} && "
+            f"git clone -q --shared --no-checkout ~/{remote_repo} ~/{workspace} && "
+            f"git -C ~/{workspace} -c advice.detachedHead=false checkout -q {commit}"
         ),
     )
+    if out.failed:
+        raise RuntimeError("checking out the commit on remote failed")
     helpers.remote_run(ip=ip, command="ls -a")
 
-    out = io.StringIO()
-
-    # install build reqs
-    helpers.remote_run(
-        ip=ip, command="sudo bash ~/build/install-reqs.sh", pty=True, out_stream=out
-    )
-
-    # there's a lot of output and it can do strange things if we don't
-    # use a buffer or file or whatever
-    cmd = (
-        "export DIB_CC_PROVENANCE={provenance}; "
-        "cd /home/cc/build/ && "
-        "python3 create-image.py --release {release} "
-        "--variant {variant} {extra_params}"
-    ).format(
-        provenance=base64.b64encode(json.dumps(metadata).encode("ascii")).decode(
-            "ascii"
-        ),
-        release=metadata["build-release"],
-        variant=variant,
-        extra_params=extra_params,
-    )
-    # DO THE THING
-    helpers.remote_run(ip=ip, command=cmd, pty=True, out_stream=out)
-
-    with open("build.log", "w") as f:
-        print(f.write(out.getvalue()))
-
-    out.seek(0)
-    ibi = "Image built in "
-    for line in out:
-        if not line.startswith(ibi):
-            continue
-        output_file = line[len(ibi) :].strip()
-        break
-    else:
-        raise RuntimeError("didn't find output file in logs.")
+    cache_env = ""
+    if dib_cache:
+        key = dibcache.cache_key(metadata)
+        cache_env = f"export DIB_IMAGE_CACHE={dib_cache.remote_dir(key)}; "
+        # restore the cache while the build reqs install
+        restore = ThreadPoolExecutor(max_workers=1)
+        restored = restore.submit(dib_cache.restore, ip, key)
+
+    try:
+        with BuildLog(log_file, markers={"output_file": IMAGE_BUILT_MARKER},
+                      max_bytes=log_max_bytes) as log:
+            # install build reqs; builds sharing a builder must not run the
+            # package manager at the same time
+            with _install_lock(ip):
+                helpers.remote_stream(ip, f"sudo bash ~/{workspace}/install-reqs.sh", log)
+
+            if dib_cache:
+                restore.shutdown()
+                try:
+                    restored.result()
+                except Exception as e:
+                    print(f"restoring dib cache {key} failed: {e}", file=sys.stderr)
+
+            cmd = (
+                cache_env +
+                "export DIB_CC_PROVENANCE={provenance}; "
+                "cd /home/cc/{workspace}/ && "
+                "python3 create-image.py --release {release} "
+                "--variant {variant} {extra_params}"
+            ).format(
+                workspace=workspace,
+                provenance=base64.b64encode(json.dumps(metadata).encode("ascii")).decode(
+                    "ascii"
+                ),
+                release=metadata["build-release"],
+                variant=variant,
+                extra_params=extra_params,
+            )
+            # DO THE THING
+            status = helpers.remote_stream(ip, cmd, log)
+
+        output_file = log.matches.get("output_file")
+        if dib_cache and output_file:
+            try:
+                dib_cache.save(ip, key)
+            except Exception as e:
+                print(f"saving dib cache {key} failed: {e}", file=sys.stderr)
+    finally:
+        if dib_cache:
+            # also when the build failed: never leave the restore running
+            # or the key marked in use
+            restore.shutdown()
+            dib_cache.release(ip, key)
+
+    if not output_file:
+        print(log.tail(), file=sys.stderr)
+        raise RuntimeError(
+            f"didn't find output file in logs (create-image.py exited {status}), "
+            f"see {log_file}"
+        )
 
     out = io.StringIO()
     tmp_dir_file_name = output_file.rsplit("/", 1)
@@ -135,79 +194,94 @@ def do_build(ip, rc, repodir, commit, metadata, variant, extra_params):
     result = []
     for img_file in out:
         img_file = img_file.strip()
+        # each result gets its own metadata; for IPA builds they differ
+        img_metadata = dict(metadata)
         if metadata["build-distro"].startswith("ipa_"):
-            ipa_image = img_file.rsplit(".", 1)[1]
-            metadata["build-ipa"] = ipa_image
-        checksum_result = helpers.remote_run(ip=ip, command=f"md5sum {img_file}")
-        checksum = checksum_result.stdout.split()[0].strip()
+            img_metadata["build-ipa"] = img_file.rsplit(".", 1)[1]
         result.append(
             {
                 "image_loc": img_file,
-                "checksum": checksum,
-                "metadata": metadata,
+                "metadata": img_metadata,
             }
         )
 
     return result
 
 
-def do_upload(ip, rc, disk_format, **build_results):
+def convert_image(ip, image_loc, disk_format):
+    """
+    Convert a qcow2 build output to disk_format on the builder, with
+    parallel coroutines, out-of-order writes and sparse output.
+    """
+    if image_loc.endswith(".qcow2"):
+        converted_image = image_loc[:-6] + ".img"
+    else:
+        converted_image = image_loc + ".img"
+    out = helpers.remote_run(
+        ip=ip,
+        command="qemu-img convert -m {} -W -S 4k -f qcow2 -O {} {} {}".format(
+            CONVERT_COROUTINES, disk_format, image_loc, converted_image
+        ),
+    )
+    if out.failed:
+        raise RuntimeError("converting image failed")
+    return converted_image
+
+
+def do_upload(ip, rc, disk_format, name_suffix="", **build_results):
     glance = chi.glance()
     metadata = build_results["metadata"]
 
+    image_loc = build_results["image_loc"]
     if disk_format == "raw":
-        if build_results["image_loc"].endswith(".qcow2"):
-            converted_image = build_results["image_loc"][:-6] + ".img"
-        else:
-            converted_image = build_results["image_loc"] + ".img"
-        out = helpers.remote_run(
-            ip=ip,
-            command="qemu-img convert -f qcow2 -O {} {} {}".format(
-                disk_format, build_results["image_loc"], converted_image
-            ),
-        )
-        if out.failed:
-            raise RuntimeError("converting image failed")
-        build_results["image_loc"] = converted_image
-        build_results["checksum"] = (
-            helpers.remote_run(ip=ip, command="md5sum {}".format(converted_image))
-            .split()[0]
-            .strip()
-        )
+        image_loc = convert_image(ip, image_loc, disk_format)
 
     image = glance.images.create(
-        name="image-{}-{}-{}".format(
+        name="image-{}-{}-{}{}".format(
             metadata["build-distro"],
             metadata["build-release"],
             metadata["build-tag"],
+            name_suffix,
         ),
         disk_format=disk_format,
         container_format="bare",
         **metadata,
     )
 
+    # stream the file to Glance and checksum it in the same read
     session = chi.session()
+    fifo = f"{image_loc}.{image['id']}.fifo"
+    md5_file = f"{image_loc}.{image['id']}.md5"
     upload_command = textwrap.dedent(
-        """\
-        curl -i -X PUT -H "X-Auth-Token: {token}" \
+        """        set -o pipefail; rm -f {fifo} && mkfifo {fifo} && \
+        {{ md5sum < {fifo} > {md5_file} 2>/dev/null & }} && \
+        tee {fifo} < "{filepath}" | \
+        curl -sSf -X PUT -H "X-Auth-Token: {token}" \
             -H "Content-Type: application/octet-stream" \
             -H "Connection: keep-alive" \
-            -T "{filepath}" \
-            {url}""".format(
+            -T - \
+            {url} && \
+        wait && cut -d' ' -f1 {md5_file}; \
+        status=$?; rm -f {fifo} {md5_file}; exit $status""".format(
+            fifo=fifo,
+            md5_file=md5_file,
             token=session.get_token(),
-            filepath=build_results["image_loc"],
+            filepath=image_loc,
             url=session.get_endpoint(service_type="image")
             + f"/v2/images/{image['id']}/file",
         )
     )
-    helpers.remote_run(ip=ip, command=upload_command)
+    out = helpers.remote_run(ip=ip, command=upload_command, hide=True)
+    if out.failed:
+        raise RuntimeError(f"uploading {image_loc} failed: {out.stderr}")
+    checksum = out.stdout.strip()
 
     image = glance.images.get(image["id"])
 
-    if build_results["checksum"] != image["checksum"]:
+    if checksum != image["checksum"]:
         raise RuntimeError(
             "checksum mismatch! build: {} vs glance: {}".format(
-                repr(build_results["checksum"]),
+                repr(checksum),
                 repr(image["checksum"]),
             )
         )
@@ -215,15 +289,237 @@ def do_upload(ip, rc, disk_format, **build_results):
     return image
 
 
+def do_central_upload(ip, central_session, disk_format, name_suffix="",
+                      concurrency=8, **build_results):
+    """
+    Upload a build output from the builder straight into the private
+    staging container of the centralized store as a segmented object, and
+    register it in the central Glance by location. imagedist moves it into
+    the centralized container when it publishes the image.
+    """
+    glance = chi.glance(session=central_session)
+    metadata = build_results["metadata"]
+
+    image_loc = build_results["image_loc"]
+    if disk_format == "raw":
+        image_loc = convert_image(ip, image_loc, disk_format)
+
+    image = glance.images.create(
+        name="image-{}-{}-{}{}".format(
+            metadata["build-distro"],
+            metadata["build-release"],
+            metadata["build-tag"],
+            name_suffix,
+        ),
+        disk_format=disk_format,
+        container_format="bare",
+        **metadata,
+    )
+    container = helpers.CENTRALIZED_STAGING_CONTAINER_NAME
+    swift_conn = helpers.connect_to_swift_with_admin(
+        central_session, helpers.CENTRALIZED_STORE_REGION_NAME
+    )
+    objects = [image["id"]]
+    try:
+        # no read ACL: nothing staged is visible to the sites
+        swift_conn.put_container(container)
+        out = helpers.remote_run(ip=ip, command=f"stat -c %s {image_loc}", hide=True)
+        size = int(out.stdout.strip())
+        token = central_session.get_token()
+        container_url = "{}/{}".format(
+            central_session.get_endpoint(
+                service_type="object-store",
+                region_name=helpers.CENTRALIZED_STORE_REGION_NAME,
+                interface="public",
+            ),
+            container,
+        )
+
+        def _put_segment(index):
+            # segments are named like Glance's swift store names them
+            segment = "{}-{:05d}".format(image["id"], index + 1)
+            command = (
+                "set -o pipefail; "
+                f"dd if={image_loc} iflag=skip_bytes,count_bytes bs=4M status=none "
+                f"skip={index * CENTRAL_SEGMENT_SIZE} count={CENTRAL_SEGMENT_SIZE} | "
+                f"curl -sSf -X PUT -H 'X-Auth-Token: {token}' -T - {container_url}/{segment}"
+            )
+            delays = waiter.backoff_delays()
+            for attempt in range(5):
+                if attempt:
+                    time.sleep(next(delays))
+                out = helpers.remote_run(ip=ip, command=command, hide=True)
+                if not out.failed:
+                    return segment
+            raise RuntimeError(f"uploading segment {segment} failed: {out.stderr}")
+
+        def _checksums():
+            # md5 and sha512 in a single read, while the segments upload
+            out = helpers.remote_run(
+                ip=ip,
+                command=(
+                    "python3 -c 'import hashlib, sys; "
+                    "md5, sha = hashlib.md5(), hashlib.sha512(); "
+                    "f = open(sys.argv[1], \"rb\"); "
+                    "[(md5.update(b), sha.update(b)) for b in iter(lambda: f.read(1 << 22), b\"\")]; "
+                    f"print(md5.hexdigest(), sha.hexdigest())' {image_loc}"
+                ),
+                hide=True,
+            )
+            if out.failed:
+                raise RuntimeError(f"checksumming {image_loc} failed: {out.stderr}")
+            return out.stdout.split()
+
+        segment_count = max(1, -(-size // CENTRAL_SEGMENT_SIZE))
+        objects.extend(
+            "{}-{:05d}".format(image["id"], index + 1) for index in range(segment_count)
+        )
+        with ThreadPoolExecutor(max_workers=concurrency + 1) as executor:
+            checksums = executor.submit(_checksums)
+            list(executor.map(_put_segment, range(segment_count)))
+            checksum, os_hash_value = checksums.result()
+
+        # no build-* metadata until it is published
+        swift_conn.put_object(
+            container, image["id"], contents=b"",
+            headers={"x-object-manifest": f"{container}/{image['id']}-"},
+        )
+
+        glance.images.add_location(
+            image["id"],
+            f"{helpers.CENTRALIZED_STAGING_LOCATION_PREFIX}/{image['id']}",
+            {"store": helpers.CENTRALIZED_STORE},
+            validation_data={
+                "checksum": checksum,
+                "os_hash_algo": "sha512",
+                "os_hash_value": os_hash_value,
+            },
+        )
+    except Exception:
+        glance.images.delete(image["id"])
+        for obj in objects:
+            try:
+                swift_conn.delete_object(container, obj)
+            except Exception as e:
+                if helpers.get_http_status(e) != 404:
+                    print(f"failed to delete {container}/{obj}: {e}", file=sys.stderr)
+        raise
+
+    return glance.images.get(image["id"])
+
+
+def build_metadata(supports, distro, release, variant, commit, builder_image):
+    image_revision = helpers.get_latest_revision(distro, release)
+    repo_location = supports.distros[distro]["repo_location"]
+
+    print(f"Latest {distro}-{release} cloud image revision: {image_revision}")
+
+    metadata = {
+        "build-variant": variant,
+        "build-distro": distro,
+        "build-release": release,
+        "build-os-base-image-revision": image_revision,
+        "build-repo": repo_location,
+        "build-repo-commit": commit,
+        "build-timestamp": str(datetime.datetime.now().timestamp()),
+        "build-tag": BUILD_TAG,
+        "build-ipa": "na",
+        helpers.BUILD_KEY_PROPERTY: helpers.build_key(
+            supports, distro, release, variant, image_revision, commit, builder_image
+        ),
+    }
+    metadata.update(supports.variant_metadata(variant))
+    return metadata
+
+
+def build_image(ip, rc, repodir, commit, metadata, variant, extra_params,
+                disk_format, workspace="build", log_file="build.log", log_max_bytes=None,
+                dib_cache=None, central_session=None):
+    """
+    Build on the builder at ip and upload every resulting image to Glance,
+    or straight to the centralized store if central_session is given.
+    """
+    build_results = do_build(
+        ip,
+        rc,
+        repodir,
+        commit,
+        metadata,
+        variant=variant,
+        extra_params=extra_params,
+        workspace=workspace,
+        log_file=log_file,
+        log_max_bytes=log_max_bytes,
+        dib_cache=dib_cache,
+    )
+    pprint(build_results)
+
+    # every artifact in every format is converted and uploaded in parallel
+    disk_formats = disk_format.split(",")
+    uploads = [
+        (result, fmt) for result in build_results for fmt in disk_formats
+    ]
+    if not uploads:
+        raise RuntimeError("no build outputs found")
+
+    def _upload(upload):
+        result, fmt = upload
+        name_suffix = f"-{fmt}" if len(disk_formats) > 1 else ""
+        if central_session:
+            return do_central_upload(
+                ip, central_session, fmt, name_suffix=name_suffix, **result
+            )
+        return do_upload(ip, rc, fmt, name_suffix=name_suffix, **result)
+
+    with ThreadPoolExecutor(max_workers=min(len(uploads), UPLOAD_CONCURRENCY)) as executor:
+        glance_results = list(executor.map(_upload, uploads))
+    for image in glance_results:
+        pprint(image)
+    return glance_results
+
+
+def add_dib_cache_arguments(parser):
+    parser.add_argument(
+        "--dib-cache",
+        choices=["none", "builder", "swift"],
+        default="none",
+        help="Keep the diskimage-builder cache between builds on the builder, "
+        "or also in Swift on the build site; default none",
+    )
+    parser.add_argument(
+        "--dib-cache-max-gb",
+        type=int,
+        default=50,
+        help="Size cap of the cache on a builder and in Swift; default 50",
+    )
+    parser.add_argument(
+        "--dib-cache-container",
+        type=str,
+        default=dibcache.DEFAULT_CONTAINER,
+        help=f"Swift container of the cache; default {dibcache.DEFAULT_CONTAINER}",
+    )
+
+
+def dib_cache_from_args(args):
+    if args.dib_cache == "none":
+        return None
+    return dibcache.DibCache(
+        args.dib_cache,
+        max_bytes=args.dib_cache_max_gb * 2**30,
+        container=args.dib_cache_container,
+    )
+
+
 def main():
-    supports = parse_config("../supports.yaml")
+    supports = catalog.load()
 
     parser = argparse.ArgumentParser(description=__doc__)
 
     parser.add_argument(
         "--node-type",
         type=str,
-        help="Create a lease for the builder with the selected node type",
+        help="Create a lease for the builder with the selected node type; "
+        "default from the variant in supports.yaml",
     )
     parser.add_argument(
         "--use-lease",
@@ -247,13 +543,13 @@ def main():
     parser.add_argument(
         "--builder-image",
         type=str,
-        required=True,
-        help="Name or ID of image to launch.",
+        help="Name or ID of image to launch; default from the release in "
+        "supports.yaml",
     )
     parser.add_argument(
         "--distro",
         type=str,
-        choices=supports["supported_distros"].keys(),
+        choices=supports.distros.keys(),
         required=True,
         help="Build the selected distro image",
     )
@@ -266,12 +562,75 @@ def main():
     parser.add_argument(
         "--variant",
         type=str,
-        choices=supports["supported_variants"].keys(),
+        choices=supports.variants.keys(),
         help="Image variant to build.",
     )
     parser.add_argument(
-        "--disk-format", type=str, default="qcow2", help="Disk format of the image"
+        "--disk-format",
+        type=str,
+        default="qcow2",
+        help="Disk format of the image; comma-separated to upload several, "
+        "e.g. qcow2,raw",
+    )
+    parser.add_argument(
+        "--builder-pool",
+        action="store_true",
+        help="Take a warm builder from the pool shared by builds on this host "
+        "and return it afterwards instead of deleting its lease.",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=1,
+        help="Idle builders kept per node type and builder image; default 1",
+    )
+    parser.add_argument(
+        "--pool-idle-ttl-hours",
+        type=int,
+        default=12,
+        help="Tear down pooled builders idle for longer than this; default 12",
+    )
+    parser.add_argument(
+        "--pool-clean",
+        type=str,
+        choices=["wipe", "rebuild"],
+        default="wipe",
+        help="How to clean a builder between builds: wipe the build "
+        "workspace or rebuild the server from its image; default wipe",
+    )
+    parser.add_argument(
+        "--pool-file",
+        type=str,
+        default=DEFAULT_POOL_FILE,
+        help="State file of the builder pool.",
+    )
+    parser.add_argument(
+        "--log-file",
+        type=str,
+        default="build.log",
+        help="Where to stream the build output; a .gz name is compressed. "
+        "Default build.log",
     )
+    parser.add_argument(
+        "--log-max-mb",
+        type=int,
+        help="Rotate the build log once it reaches this size.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Build even if an image with the same build key exists.",
+    )
+    parser.add_argument(
+        "--publish-central",
+        type=str,
+        metavar="AUTH_JSON",
+        help="Upload straight from the builder to the staging container of the "
+        "centralized store, "
+        "using the credentials of the centralized site in this auth file "
+        "({\"auths\": {\"<site>\": {\"<OS_var>\": \"<value>\"}}})",
+    )
+    add_dib_cache_arguments(parser)
     parser.add_argument("build_repo", type=str, help="Path of repo to push and build.")
 
     args = parser.parse_args()
@@ -280,97 +639,91 @@ def main():
 
     if not args.key_name:
         args.key_name = os.environ.get("SSH_KEY_NAME", "default")
-
-    image_revision = helpers.get_latest_revision(args.distro, args.release)
-    repo_location = supports["supported_distros"][args.distro]["repo_location"]
-
-    print(f"Latest {args.distro}-{args.release} cloud image revision: {image_revision}")
+    if not args.builder_image:
+        args.builder_image = supports.builder_image(args.distro, args.release)
+    if not args.node_type and not args.use_lease:
+        args.node_type = supports.node_type(args.variant)
 
     commit = helpers.get_local_rev(args.build_repo)
-    metadata = {
-        "build-variant": args.variant,
-        "build-distro": args.distro,
-        "build-release": args.release,
-        "build-os-base-image-revision": image_revision,
-        "build-repo": repo_location,
-        "build-repo-commit": commit,
-        "build-timestamp": str(datetime.datetime.now().timestamp()),
-        "build-tag": BUILD_TAG,
-        "build-ipa": "na",
-    }
-    if "variant_metadata" in supports["supported_variants"][args.variant]:
-        metadata.update(
-            supports["supported_variants"][args.variant]["variant_metadata"]
-        )
+    metadata = build_metadata(
+        supports, args.distro, args.release, args.variant, commit, args.builder_image
+    )
     pprint(metadata)
 
-    print("Lease: creating...")
-    lease_name = "lease-{}".format(BUILD_TAG)
-    server_name = "instance-{}".format(BUILD_TAG)
+    central_session = None
+    if args.publish_central:
+        with open(args.publish_central) as f:
+            central_rc = json.load(f)["auths"][helpers.CENTRALIZED_STORE_SITE]
+        central_session = helpers.get_auth_session_from_rc(central_rc)
 
-    if args.use_lease:
-        lease = chi_lease.get_lease(args.use_lease)
-    else:
-        reservations = []
-        chi_lease.add_node_reservation(reservations, count=1, node_type=args.node_type)
-        if args.reserve_ip:
-            chi_lease.add_fip_reservation(reservations, count=1)
-        lease = chi_lease.create_lease(lease_name, reservations)
-        if not lease:
-            print("Not enough nodes to satisfy your request! Try again later!")
+    if not args.force:
+        # look where this build would upload to
+        existing = helpers.find_images_by_build_key(
+            chi.glance(session=central_session), metadata[helpers.BUILD_KEY_PROPERTY]
+        )
+        if existing:
+            print("Identical build already exists, skipping: {}".format(
+                ", ".join(img["id"] for img in existing)
+            ))
+            print(existing[-1]["id"])
             return
 
-    print("Waiting for lease to become active...")
-    time.sleep(60)
-    chi_lease.wait_for_active(lease["id"])
-    time.sleep(60)
-    print(" - started {}".format(lease["name"]))
-
-    print("Server: creating...")
-    reservation_id = chi_lease.get_node_reservation(lease["id"])
-    server = chi_server.create_server(
-        server_name,
-        image_name=args.builder_image,
-        flavor_name="baremetal",
-        key_name=args.key_name,
-        reservation_id=reservation_id,
-    )
-
-    print(" - building...")
-    time.sleep(60)
-    chi_server.wait_for_active(server.id)
-    time.sleep(60)
-    print(" - started {}...".format(server.name))
-    if args.reserve_ip:
-        ip = chi_lease.get_reserved_floating_ips(lease["id"])[0]
-        print(f"Associating IP {ip} to server {server.id}...")
-        chi_server.associate_floating_ip(server.id, ip)
+    builder = None
+    pool = None
+    if args.builder_pool:
+        pool = BuilderPool(
+            args.pool_file, size=args.pool_size, idle_ttl_hours=args.pool_idle_ttl_hours
+        )
+        pool.expire()
+        builder = pool.acquire(args.node_type, args.builder_image, BUILD_TAG)
+    if builder is None:
+        try:
+            builder = provision_builder(
+                BUILD_TAG,
+                args.node_type,
+                args.builder_image,
+                args.key_name,
+                reserve_ip=args.reserve_ip,
+                use_lease=args.use_lease,
+            )
+        except RuntimeError as e:
+            print(e)
+            return
+        if pool:
+            pool.add(builder)
+    ip = builder["ip"]
+
+    extra_params = supports.extra_params(args.distro)
+
+    try:
+        glance_results = build_image(
+            ip,
+            rc,
+            args.build_repo,
+            commit,
+            metadata,
+            args.variant,
+            extra_params,
+            args.disk_format,
+            log_file=args.log_file,
+            log_max_bytes=args.log_max_mb * 2**20 if args.log_max_mb else None,
+            dib_cache=dib_cache_from_args(args),
+            central_session=central_session,
+        )
+    except Exception:
+        if pool:
+            # the builder is in an unknown state
+            pool.release(builder, healthy=False)
+        raise
+
+    if pool:
+        print("Returning builder to the pool...")
+        pool.release(builder, clean=args.pool_clean)
     else:
-        print(f"Associatign ad-hoc IP to server {server.id}")
-        ip = chi_server.associate_floating_ip(server.id)
-
-    extra_params = supports["supported_distros"][args.distro].get("extra_params", "")
-
-    build_results = do_build(
-        ip,
-        rc,
-        args.build_repo,
-        commit,
-        metadata,
-        variant=args.variant,
-        extra_params=extra_params,
-    )
-    pprint(build_results)
-
-    glance_results = None
-    for result in build_results:
-        glance_results = do_upload(ip, rc, args.disk_format, **result)
-        pprint(glance_results)
-
-    print("Tearing down...")
-    chi_lease.delete_lease(lease["id"])
+        print("Tearing down...")
+        teardown_builder(builder)
 
-    print(glance_results["id"])
+    print(glance_results[-1]["id"])
 
 
 if __name__ == "__main__":
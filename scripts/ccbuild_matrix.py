@@ -0,0 +1,360 @@
+'''
+Build many images at once on a bounded set of builder nodes.
+
+Targets are given as distro:release:variant (or --all for every entry in
+supports.yaml). Targets needing the same builder node type and image share
+builders, and a big builder runs several diskimage-builder builds at once
+when its CPUs and disk allow. Each target gets its own log file under
+--log-dir and a line in the results file.
+
+Each distro's repository must already be cloned under --repos-dir in its
+`local_repo` directory, as do_build.sh does.
+'''
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import chi
+
+from builder_pool import provision_builder, teardown_builder
+from ccbuild import (
+    BUILD_TAG,
+    add_dib_cache_arguments,
+    build_image,
+    build_metadata,
+    dib_cache_from_args,
+)
+
+sys.path.append("..")
+from utils import catalog, helpers
+
+
+# resources one diskimage-builder build needs to run alongside others
+CPUS_PER_BUILD = 16
+DISK_PER_BUILD_GB = 60
+
+
+def expand_targets(supports, target_args=None):
+    """
+    Return (distro, release, variant) tuples for the given
+    distro:release:variant strings, or for the whole matrix.
+    """
+    if not target_args:
+        return list(supports.targets)
+
+    targets = [tuple(t.split(":")) for t in target_args]
+    for target in targets:
+        if len(target) != 3:
+            raise ValueError(f"target {':'.join(target)} is not distro:release:variant")
+    return targets
+
+
+def builder_key(supports, distro, release, variant):
+    return supports.node_type(variant), supports.builder_image(distro, release)
+
+
+def detect_slots(ip):
+    chi.server.wait_for_tcp(ip, port=22)
+    nproc = helpers.remote_run(ip=ip, command="nproc", retries=360)
+    avail = helpers.remote_run(ip=ip, command="df -B1 --output=avail /tmp | tail -1")
+    cpus = int(nproc.stdout.strip())
+    disk_gb = int(avail.stdout.strip()) // 2**30
+    return max(1, min(cpus // CPUS_PER_BUILD, disk_gb // DISK_PER_BUILD_GB))
+
+
+class BuilderScheduler:
+    """
+    Hands out build slots on at most max_builders builders. A new builder
+    is provisioned when a target finds no free slot for its key; when the
+    limit is reached, builders whose key has no remaining targets are torn
+    down to make room.
+    """
+
+    def __init__(self, max_builders, builds_per_node, key_name, demand):
+        self.max_builders = max_builders
+        self.builds_per_node = builds_per_node
+        self.key_name = key_name
+        # remaining targets per builder key
+        self.demand = dict(demand)
+        self.builders = []
+        self._cond = threading.Condition()
+
+    def _claim(self, key):
+        """
+        Claim a slot, returning the builder and whether it still needs to be
+        provisioned by the caller, or (None, False) if none is available.
+        """
+        for b in self.builders:
+            if b["key"] == key and b["in_use"] < b["slots"]:
+                b["in_use"] += 1
+                return b, False
+        if self._waiting_for_slots(key):
+            return None, False
+        if len(self.builders) < self.max_builders:
+            b = {
+                "key": key,
+                "entry": None,
+                "ready": threading.Event(),
+                # until the builder is up, only assume what was asked for
+                "slots": self.builds_per_node or 1,
+                "in_use": 1,
+            }
+            self.builders.append(b)
+            return b, True
+        return None, False
+
+    def _waiting_for_slots(self, key):
+        """
+        Whether a builder for key is still being provisioned and its number
+        of slots is not known yet; targets of key wait for it rather than
+        provisioning builders of their own.
+        """
+        return not self.builds_per_node and any(
+            b["key"] == key and b["entry"] is None for b in self.builders
+        )
+
+    def _retire_idle(self):
+        for b in self.builders:
+            if b["entry"] and b["in_use"] == 0 and not self.demand.get(b["key"]):
+                self.builders.remove(b)
+                return b
+        return None
+
+    def acquire(self, key, name):
+        while True:
+            retired = None
+            with self._cond:
+                b, provision = self._claim(key)
+                if b is None:
+                    if not self._waiting_for_slots(key):
+                        retired = self._retire_idle()
+                    if retired is None:
+                        self._cond.wait()
+                        continue
+            if retired:
+                teardown_builder(retired["entry"])
+                continue
+            break
+
+        if provision:
+            node_type, builder_image = key
+            entry = None
+            try:
+                entry = provision_builder(
+                    f"{BUILD_TAG}-{name}", node_type, builder_image, self.key_name
+                )
+                slots = self.builds_per_node or detect_slots(entry["ip"])
+            except Exception:
+                if entry is not None:
+                    teardown_builder(entry)
+                with self._cond:
+                    self.builders.remove(b)
+                    self._cond.notify_all()
+                b["ready"].set()
+                raise
+            with self._cond:
+                b["entry"] = entry
+                b["slots"] = slots
+                self._cond.notify_all()
+            print(f"builder {entry['ip']} for {key} has {slots} build slots")
+            b["ready"].set()
+        else:
+            b["ready"].wait()
+            if b["entry"] is None:
+                # its provisioning failed; try for another builder
+                return self.acquire(key, name)
+        return b
+
+    def release(self, b):
+        with self._cond:
+            b["in_use"] -= 1
+            self.demand[b["key"]] -= 1
+            self._cond.notify_all()
+
+    def skip(self, key):
+        """
+        Account for a target of key that finished without a builder.
+        """
+        with self._cond:
+            self.demand[key] -= 1
+            self._cond.notify_all()
+
+    def teardown_all(self):
+        with self._cond:
+            builders = [b for b in self.builders if b["entry"]]
+            self.builders = []
+        for b in builders:
+            teardown_builder(b["entry"])
+
+
+def build_target(scheduler, supports, rc, repos_dir, log_dir, dib_cache, force, target):
+    distro, release, variant = target
+    name = f"{distro}-{release}-{variant}"
+    result = {
+        "target": name,
+        "status": "failed",
+        "images": [],
+        "builder": None,
+        "error": None,
+        "duration_seconds": None,
+    }
+    start = time.monotonic()
+    key = builder_key(supports, distro, release, variant)
+
+    b = None
+    try:
+        repodir = os.path.join(repos_dir, supports.distros[distro]["local_repo"])
+        commit = helpers.get_local_rev(repodir)
+        metadata = build_metadata(supports, distro, release, variant, commit, key[1])
+
+        existing = [] if force else helpers.find_images_by_build_key(
+            chi.glance(), metadata[helpers.BUILD_KEY_PROPERTY]
+        )
+        if existing:
+            # an identical image exists; don't lease a builder for it
+            result["images"] = [img["id"] for img in existing]
+            result["status"] = "skipped"
+            print(f"{name}: identical image exists, skipped")
+            return result
+
+        b = scheduler.acquire(key, name)
+        result["builder"] = b["entry"]["ip"]
+        print(f"{name}: building on {b['entry']['ip']}")
+        images = build_image(
+            b["entry"]["ip"],
+            rc,
+            repodir,
+            commit,
+            metadata,
+            variant,
+            supports.extra_params(distro),
+            supports.disk_format(distro),
+            workspace=f"build-{re.sub('[^A-Za-z0-9_.-]', '_', name)}",
+            log_file=os.path.join(log_dir, f"{name}.log"),
+            dib_cache=dib_cache,
+        )
+        result["images"] = [img["id"] for img in images]
+        result["status"] = "succeeded"
+    except Exception as e:
+        traceback.print_exc()
+        result["error"] = str(e)
+    finally:
+        if b is not None:
+            scheduler.release(b)
+        else:
+            scheduler.skip(key)
+        result["duration_seconds"] = int(time.monotonic() - start)
+
+    print(f"{name}: {result['status']}")
+    return result
+
+
+def main():
+    supports = catalog.load()
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    targets_group = parser.add_mutually_exclusive_group(required=True)
+    targets_group.add_argument(
+        "--targets",
+        type=str,
+        nargs="+",
+        metavar="DISTRO:RELEASE:VARIANT",
+        help="Images to build.",
+    )
+    targets_group.add_argument(
+        "--all",
+        action="store_true",
+        help="Build every image in supports.yaml.",
+    )
+    parser.add_argument(
+        "--max-builders",
+        type=int,
+        default=4,
+        help="Maximum number of builder nodes leased at once; default 4",
+    )
+    parser.add_argument(
+        "--builds-per-node",
+        type=int,
+        help="Builds to run at once on a builder; default from its CPUs and disk",
+    )
+    parser.add_argument(
+        "--key-name",
+        type=str,
+        default=os.environ.get("SSH_KEY_NAME", "default"),
+        help="SSH keypair name on OS used to create builders.",
+    )
+    parser.add_argument(
+        "--repos-dir",
+        type=str,
+        default=".",
+        help="Directory holding each distro's local_repo clone; default .",
+    )
+    parser.add_argument(
+        "--log-dir",
+        type=str,
+        default="matrix-logs",
+        help="Directory for per-target build logs; default matrix-logs",
+    )
+    parser.add_argument(
+        "--results",
+        type=str,
+        default="matrix-results.json",
+        help="File to write per-target results to; default matrix-results.json",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Build targets even if an image with the same build key exists.",
+    )
+    add_dib_cache_arguments(parser)
+
+    args = parser.parse_args()
+
+    rc = helpers.get_rc_from_env()
+    targets = expand_targets(supports, args.targets)
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    demand = {}
+    for target in targets:
+        key = builder_key(supports, *target)
+        demand[key] = demand.get(key, 0) + 1
+
+    # shared so concurrent builds never evict each other's cache
+    dib_cache = dib_cache_from_args(args)
+    scheduler = BuilderScheduler(
+        args.max_builders, args.builds_per_node, args.key_name, demand
+    )
+    try:
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            results = list(executor.map(
+                lambda t: build_target(
+                    scheduler, supports, rc, args.repos_dir, args.log_dir, dib_cache,
+                    args.force, t,
+                ),
+                targets,
+            ))
+    finally:
+        scheduler.teardown_all()
+
+    with open(args.results, "w") as f:
+        json.dump(results, f, indent=2)
+
+    for r in results:
+        print(f"{r['target']:<30} {r['status']:<10} {r['duration_seconds']:>6}s "
+              f"{','.join(r['images']) or r['error']}")
+
+    return 0 if all(r["status"] in ("succeeded", "skipped") for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
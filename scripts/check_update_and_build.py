@@ -11,10 +11,9 @@ import subprocess
 import sys
 import tempfile
 import yaml
-from . import imagedist
 
 sys.path.append("..")
-from utils import helpers, jenkinshelper
+from utils import catalog, helpers, jenkinshelper
 
 
 def get_image_by_name(auth_data, name):
@@ -33,12 +32,20 @@ def get_image_by_name(auth_data, name):
         return images[0]
 
 
+def get_remote_head(repo_location):
+    branch = os.environ.get("BUILDER_BRANCH", "master")
+    proc = helpers.run(f"git ls-remote {repo_location}.git refs/heads/{branch}")
+    if proc.returncode != 0 or not proc.stdout.strip():
+        raise RuntimeError(f"could not resolve {branch} of {repo_location}")
+    return proc.stdout.split()[0]
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
 
-    with open("../supports.yaml", 'r') as f:
-        supports = yaml.safe_load(f)
+    # loaded like ccbuild does so build keys match
+    supports = catalog.load()
 
     parser = argparse.ArgumentParser(
         description=__doc__,
@@ -57,28 +64,48 @@ def main(argv=None):
     with open(args.auth_json) as f:
         auth_data = json.load(f)["auths"]["tacc"]
 
-    for distro in supports["supported_distros"].keys():
-        releases = supports["supported_distros"][distro]
-        for release in releases:
-            # get latest base image revision
-            latest_base_image_revision = helpers.get_latest_revision(distro, release)
-            variant = release["variants"]
-            image_production_name = imagedist.production_name(
-                distro=distro, release=release, variant=variant)
-            current_image = get_image_by_name(auth_data, image_production_name)
-            if (
-                not current_image or
-                    current_image["build-os-base-image-revision"] != latest_base_image_revision
-            ):
-                # release new image
-                with open(args.jenkins.yaml, 'r') as f:
-                    jenkins_creds = yaml.safe_load(f)
-                jenkins_server = jenkinshelper.connect_to_jenkins(
-                    jenkins_creds["username"], jenkins_creds["passwords"]
-                )
-                jenkinshelper.build_image(
-                    jenkins_server, distro, release, variant
-                )
+    jenkins_server = None
+    commits = {}
+    # get latest base image revisions, every release at once
+    revisions = helpers.get_latest_revisions(
+        (distro, release) for distro, release, _ in supports.targets
+    )
+    for distro, release, variant in supports.targets:
+        if distro not in commits:
+            commits[distro] = get_remote_head(supports.distros[distro]["repo_location"])
+        latest_base_image_revision = revisions[(distro, release)]
+        image_production_name = supports.production_name(
+            distro, release, variant,
+            "kernel" if catalog.is_ipa(distro) else "na",
+        )
+        current_image = get_image_by_name(auth_data, image_production_name)
+        build_key = helpers.build_key(
+            supports, distro, release, variant,
+            latest_base_image_revision, commits[distro],
+            supports.builder_image(distro, release),
+        )
+        if current_image and helpers.BUILD_KEY_PROPERTY in current_image:
+            up_to_date = current_image[helpers.BUILD_KEY_PROPERTY] == build_key
+        else:
+            # images built before build keys existed
+            up_to_date = (
+                current_image is not None and
+                current_image["build-os-base-image-revision"] == latest_base_image_revision
+            )
+        if up_to_date:
+            continue
+
+        # release new image
+        print(f"{image_production_name} is out of date, building")
+        if jenkins_server is None:
+            with open(args.jenkins_yaml, 'r') as f:
+                jenkins_creds = yaml.safe_load(f)
+            jenkins_server = jenkinshelper.connect_to_jenkins(
+                jenkins_creds["username"], jenkins_creds["passwords"]
+            )
+        jenkinshelper.build_image(
+            jenkins_server, distro, release, variant
+        )
 
 
 if __name__ == '__main__':
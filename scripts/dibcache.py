@@ -0,0 +1,230 @@
+'''
+Keep the diskimage-builder cache between builds.
+
+The cache of a build lives in ~/dib-cache/{key} on the builder, where the
+key is distro-release-variant-base_image_revision, and create-image.py is
+pointed at it with DIB_IMAGE_CACHE. In "builder" mode it simply stays on
+a pooled builder for the next build with the same key. In "swift" mode it
+is also saved to and restored from a container on the build site: one
+gzipped tarball per top-level cache entry, streamed between tar on the
+builder and Swift with curl, several at a time. Only entries that changed
+since the restore are saved again.
+
+Both the builder and the container are capped in size, evicting the least
+recently used keys first.
+'''
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import chi
+
+sys.path.append("..")
+from utils import helpers
+
+
+REMOTE_CACHE_DIR = "/home/cc/dib-cache"
+DEFAULT_CONTAINER = "dib-cache"
+LAST_USED = ".last-used"
+# touched after a restore or save; entries newer than it need saving
+SYNCED = ".synced"
+
+
+def cache_key(metadata):
+    key = "-".join(
+        str(metadata[k]) for k in (
+            "build-distro",
+            "build-release",
+            "build-variant",
+            "build-os-base-image-revision",
+        )
+    )
+    return re.sub("[^A-Za-z0-9_.-]", "_", key)
+
+
+class DibCache:
+    def __init__(self, mode="builder", max_bytes=50 * 2**30,
+                 container=DEFAULT_CONTAINER, concurrency=4):
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.container = container
+        self.concurrency = concurrency
+        # (ip, key) of builds running now, never evicted
+        self._in_use = set()
+        self._lock = threading.Lock()
+
+    def remote_dir(self, key):
+        return f"{REMOTE_CACHE_DIR}/{key}"
+
+    def _swift(self):
+        return helpers.connect_to_swift_with_admin(
+            chi.session(), os.environ["OS_REGION_NAME"]
+        )
+
+    def _object_url(self, name):
+        session = chi.session()
+        return "{}/{}/{}".format(
+            session.get_endpoint(service_type="object-store"),
+            self.container,
+            quote(name),
+        )
+
+    def _transfer(self, ip, commands):
+        def _run(command):
+            out = helpers.remote_run(ip=ip, command=f"set -o pipefail; {command}")
+            if out.failed:
+                print(f"dib cache transfer failed: {out.stderr}", file=sys.stderr)
+            return not out.failed
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return all(executor.map(_run, commands))
+
+    def restore(self, ip, key):
+        """
+        Make the cache for key available on the builder, downloading it
+        from the container if the builder does not have it yet.
+        """
+        with self._lock:
+            self._in_use.add((ip, key))
+        cache_dir = self.remote_dir(key)
+        out = helpers.remote_run(
+            ip=ip,
+            command=f"mkdir -p {cache_dir} && touch {cache_dir}/{LAST_USED} && ls -A {cache_dir}",
+        )
+        entries = [e for e in out.stdout.split() if not e.startswith(".")]
+        if entries:
+            print(f"dib cache {key}: warm on builder")
+            return
+        if self.mode != "swift":
+            return
+
+        try:
+            _, objects = self._swift().get_container(
+                self.container, prefix=f"{key}/", full_listing=True
+            )
+        except Exception as e:
+            if helpers.get_http_status(e) != 404:
+                raise
+            objects = []
+        archives = [o["name"] for o in objects if o["name"].endswith(".tar.gz")]
+        if not archives:
+            print(f"dib cache {key}: cold")
+            return
+
+        token = chi.session().get_token()
+        restored = self._transfer(ip, [
+            f"curl -sSf -H 'X-Auth-Token: {token}' '{self._object_url(name)}' | "
+            f"sudo tar -C {cache_dir} -xzf -"
+            for name in archives
+        ])
+        helpers.remote_run(ip=ip, command=f"touch {cache_dir}/{SYNCED}")
+        self._swift().put_object(self.container, f"{key}/{LAST_USED}", b"")
+        print(f"dib cache {key}: restored {len(archives)} entries from "
+              f"{self.container}{'' if restored else ' (some failed)'}")
+
+    def save(self, ip, key):
+        """
+        Upload what changed in the cache for key and evict old caches.
+        """
+        try:
+            if self.mode == "swift":
+                self._save_to_swift(ip, key)
+            self._evict_builder(ip)
+            if self.mode == "swift":
+                self._evict_swift(key)
+        finally:
+            self.release(ip, key)
+
+    def release(self, ip, key):
+        with self._lock:
+            self._in_use.discard((ip, key))
+
+    def _save_to_swift(self, ip, key):
+        cache_dir = self.remote_dir(key)
+        out = helpers.remote_run(
+            ip=ip,
+            command=(
+                f"cd {cache_dir} && for entry in *; do "
+                f"[ -e \"$entry\" ] || continue; "
+                f"if [ ! -e {SYNCED} ] || "
+                f"[ -n \"$(sudo find \"$entry\" -newer {SYNCED} -print -quit)\" ]; "
+                f"then echo \"$entry\"; fi; done"
+            ),
+        )
+        changed = out.stdout.split()
+        if not changed:
+            print(f"dib cache {key}: unchanged")
+            return
+
+        swift = self._swift()
+        swift.put_container(self.container)
+        token = chi.session().get_token()
+        saved = self._transfer(ip, [
+            f"sudo tar -C {cache_dir} -czf - '{entry}' | "
+            f"curl -sSf -X PUT -H 'X-Auth-Token: {token}' -T - "
+            f"'{self._object_url(f'{key}/{entry}.tar.gz')}'"
+            for entry in changed
+        ])
+        if not saved:
+            # entries stay newer than SYNCED, so the next save retries them
+            print(f"dib cache {key}: saving to {self.container} failed",
+                  file=sys.stderr)
+            return
+        helpers.remote_run(ip=ip, command=f"touch {cache_dir}/{SYNCED}")
+        swift.put_object(self.container, f"{key}/{LAST_USED}", b"")
+        print(f"dib cache {key}: saved {len(changed)} entries to {self.container}")
+
+    def _evict(self, caches, in_use):
+        """
+        caches: key -> (last used, size). Return the keys to evict, least
+        recently used first, to bring the total under max_bytes.
+        """
+        total = sum(size for _, size in caches.values())
+        evict = []
+        for key in sorted(caches, key=lambda k: caches[k][0]):
+            if total <= self.max_bytes:
+                break
+            if key in in_use:
+                continue
+            evict.append(key)
+            total -= caches[key][1]
+        return evict
+
+    def _evict_builder(self, ip):
+        out = helpers.remote_run(
+            ip=ip,
+            command=(
+                f"cd {REMOTE_CACHE_DIR} && for key in *; do "
+                f"[ -d \"$key\" ] || continue; "
+                f"echo \"$key $(stat -c %Y \"$key/{LAST_USED}\" 2>/dev/null || echo 0) "
+                f"$(sudo du -sb \"$key\" | cut -f1)\"; done"
+            ),
+        )
+        caches = {}
+        for line in out.stdout.splitlines():
+            key, last_used, size = line.split()
+            caches[key] = (int(last_used), int(size))
+        with self._lock:
+            in_use = {key for in_use_ip, key in self._in_use if in_use_ip == ip}
+        for key in self._evict(caches, in_use):
+            print(f"dib cache {key}: evicting from builder {ip}")
+            helpers.remote_run(ip=ip, command=f"sudo rm -rf {self.remote_dir(key)}")
+
+    def _evict_swift(self, current_key):
+        swift = self._swift()
+        _, objects = swift.get_container(self.container, full_listing=True)
+        caches = {}
+        names = {}
+        for obj in objects:
+            key = obj["name"].split("/", 1)[0]
+            # every restore and save rewrites {key}/.last-used
+            last_used, size = caches.get(key, ("", 0))
+            caches[key] = (max(last_used, obj["last_modified"]), size + obj["bytes"])
+            names.setdefault(key, []).append(obj["name"])
+        for key in self._evict(caches, {current_key}):
+            print(f"dib cache {key}: evicting from {self.container}")
+            for name in names[key]:
+                helpers.call_with_retries(swift.delete_object, self.container, name)
@@ -11,15 +11,16 @@ And send notifications.
 '''
 import argparse
 import chi
+import hashlib
 import json
 import operator
-import os
+import queue
 import sys
-import tempfile
-import yaml
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append("..")
-from utils import helpers
+from utils import catalog, helpers, waiter
 
 
 BASE_PROPS = {
@@ -46,101 +47,284 @@ BASE_PROPS = {
 }
 
 KEEP_SWIFT_HEADERS = ["x-object-manifest"]
+# chunks (64 KiB from glanceclient) buffered between download and upload
+RELAY_QUEUE_CHUNKS = 256
 
 
 def production_name(image=None, distro=None, release=None, variant=None,
-                    ipa=None):
+                    ipa="na"):
     if image:
         distro = image["build-distro"]
         release = image["build-release"]
         variant = image["build-variant"]
         ipa = image["build-ipa"]
 
-    with open("../supports.yaml", 'r') as f:
-        supports = yaml.safe_load(f)
-
-    prod_name = supports["supported_distros"][distro]["releases"][release]["prod_name"]
-    suffix = supports["supported_variants"][variant]["prod_name_suffix"]
-
-    if suffix:
-        prod_name = f"{prod_name}-{suffix}"
-    if ipa != "na":
-        prod_name = f"{prod_name}.{ipa}"
-
-    return prod_name
+    return catalog.load().production_name(distro, release, variant, ipa)
 
 
 def extract_extra_properties(image):
     return {k: image[k] for k in image if k not in BASE_PROPS}
 
 
-def copy_image(source_session, target_session, source_image_id):
-    glance = chi.glance(session=source_session)
-    source_image = glance.images.get(source_image_id)
-    extra = extract_extra_properties(source_image)
+def swift_meta_headers(image):
+    """
+    Object metadata the centralized store keeps for an image, so it can be
+    found and deployed without Glance.
+    """
+    meta_headers = {
+        f"{helpers.SWIFT_META_HEADER_PREFIX}{k}": f"{image[k]}"
+        for k in image.keys() if k.startswith("build")
+    }
+    meta_headers[f"{helpers.SWIFT_META_HEADER_PREFIX}disk-format"] = image["disk_format"]
+    return meta_headers
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        img_file = os.path.join(tempdir, 'image')
 
-        glance_source = chi.glance(session=source_session)
-        data = glance_source.images.data(source_image['id'])
-        with open(img_file, "wb") as f:
-            for chunk in data:
-                f.write(chunk)
+def is_in_centralized_store(site, image):
+    return (
+        site == helpers.CENTRALIZED_STORE_SITE and
+        image.get("stores", None) == helpers.CENTRALIZED_STORE
+    )
 
-        glance_target = chi.glance(session=target_session)
-        disk_format = source_image['disk_format']
-        new_image = glance_target.images.create(
-            name=source_image['name'],
-            visibility=source_image['visibility'],
-            disk_format=disk_format,
-            container_format='bare',
-            **extra)
 
+class StreamRelay:
+    """
+    File-like reader over a chunk iterator, so a download can be fed to
+    an upload without touching disk. A background thread pulls chunks into
+    a bounded queue, so both transfers run at the same time, and everything
+    read is hashed on the way through.
+    """
+
+    def __init__(self, chunks, max_chunks=RELAY_QUEUE_CHUNKS):
+        self.md5 = hashlib.md5()
+        self.bytes_read = 0
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._buffer = bytearray()
+        self._error = None
+        self._eof = False
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._pull, args=(chunks,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _pull(self, chunks):
         try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+        except Exception as e:
+            self._error = e
+        self._put(None)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self._queue.get()
+            if chunk is None:
+                self._eof = True
+                if self._error:
+                    raise self._error
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.md5.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        # unblock the download thread if the upload gave up early
+        self._closed.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def copy_image(source_session, target_session, source_image_id, swift_conn=None):
+    glance = chi.glance(session=source_session)
+    source_image = glance.images.get(source_image_id)
+    extra = extract_extra_properties(source_image)
+
+    glance_target = chi.glance(session=target_session)
+    disk_format = source_image['disk_format']
+    new_image = glance_target.images.create(
+        name=source_image['name'],
+        visibility=source_image['visibility'],
+        disk_format=disk_format,
+        container_format='bare',
+        **extra)
+
+    try:
+        data = glance.images.data(source_image['id'])
+        with StreamRelay(data) as relay:
             glance_target.images.upload(
                 new_image['id'],
-                open(img_file, "rb"),
+                relay,
                 backend=helpers.CENTRALIZED_STORE,
             )
-        except Exception as e:
-            # will raise exception if deleting fails; in this case, please
-            # manually delete the empty image!
-            glance_target.images.delete(new_image['id'])
-            raise e
+        if relay.md5.hexdigest() != source_image['checksum']:
+            raise RuntimeError('checksum mismatch reading source image')
+    except Exception as e:
+        # will raise exception if deleting fails; in this case, please
+        # manually delete the empty image!
+        glance_target.images.delete(new_image['id'])
+        raise e
+
+    new_image_full = glance_target.images.get(new_image['id'])
+    if new_image_full['checksum'] != source_image['checksum']:
+        # skip checksum check for kvm site
+        raise RuntimeError('checksum mismatch')
+
+    try:
+        set_swift_metadata(target_session, new_image, swift_conn)
+    except Exception as e:
+        glance_target.images.delete(new_image['id'])
+        raise e
+
+    return new_image_full
 
-        new_image_full = glance_target.images.get(new_image['id'])
-        if new_image_full['checksum'] != source_image['checksum']:
-            # skip checksum check for kvm site
-            raise RuntimeError('checksum mismatch')
 
-        # add metadata to swift object
+class SharedSwiftConnection:
+    """
+    One swiftclient connection to the centralized store shared by
+    concurrent publishes. swiftclient connections are not thread-safe, so
+    calls are serialized; they are only small metadata requests.
+    """
+
+    def __init__(self, session):
+        self._conn = helpers.connect_to_swift_with_admin(
+            session, helpers.CENTRALIZED_STORE_REGION_NAME
+        )
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        method = getattr(self._conn, name)
+
+        def _locked(*args, **kwargs):
+            with self._lock:
+                return method(*args, **kwargs)
+        return _locked
+
+
+def set_swift_metadata(session, image, swift_conn=None):
+    # add metadata to swift object
+    if swift_conn is None:
         swift_conn = helpers.connect_to_swift_with_admin(
-            target_session, helpers.CENTRALIZED_STORE_REGION_NAME
+            session, helpers.CENTRALIZED_STORE_REGION_NAME
         )
-        try:
-            meta_headers = {
-                f"{helpers.SWIFT_META_HEADER_PREFIX}{k}": f"{new_image[k]}"
-                for k in new_image.keys() if k.startswith("build")
-            }
-            meta_headers[f"{helpers.SWIFT_META_HEADER_PREFIX}disk-format"] = new_image["disk_format"]
-            existing_headers = swift_conn.head_object(
-                helpers.CENTRALIZED_CONTAINER_NAME, new_image['id']
-            )
-            for header in KEEP_SWIFT_HEADERS:
-                meta_headers[header] = existing_headers.get(header, None)
-
-            swift_conn.put_object(
-                container=helpers.CENTRALIZED_CONTAINER_NAME,
-                obj=new_image['id'],
-                headers=meta_headers,
-                contents=None,
-            )
-        except Exception as e:
-            glance_target.images.delete(new_image['id'])
-            raise e
+    meta_headers = swift_meta_headers(image)
+    existing_headers = swift_conn.head_object(
+        helpers.CENTRALIZED_CONTAINER_NAME, image['id']
+    )
+    for header in KEEP_SWIFT_HEADERS:
+        meta_headers[header] = existing_headers.get(header, None)
+
+    swift_conn.put_object(
+        container=helpers.CENTRALIZED_CONTAINER_NAME,
+        obj=image['id'],
+        headers=meta_headers,
+        contents=None,
+    )
 
-    return new_image_full
+
+def release_staged_object(session, image, swift_conn=None):
+    """
+    Move the object of an image uploaded by ccbuild --publish-central from
+    the private staging container into the centralized container, with its
+    metadata, and point the image at it. The segments are copied server-side.
+    Returns False if the image has nothing staged.
+    """
+    if swift_conn is None:
+        swift_conn = helpers.connect_to_swift_with_admin(
+            session, helpers.CENTRALIZED_STORE_REGION_NAME
+        )
+    staging = helpers.CENTRALIZED_STAGING_CONTAINER_NAME
+    container = helpers.CENTRALIZED_CONTAINER_NAME
+    try:
+        swift_conn.head_object(staging, image['id'])
+    except Exception as e:
+        if helpers.get_http_status(e) == 404:
+            return False
+        raise
+
+    _, segments = swift_conn.get_container(
+        staging, prefix=f"{image['id']}-", full_listing=True
+    )
+    for segment in segments:
+        swift_conn.copy_object(
+            staging, segment['name'], destination=f"/{container}/{segment['name']}"
+        )
+    meta_headers = swift_meta_headers(image)
+    meta_headers["x-object-manifest"] = f"{container}/{image['id']}-"
+    swift_conn.put_object(container, image['id'], contents=b"", headers=meta_headers)
+
+    # every step is safe to redo when retrying a partial release
+    glance = chi.glance(session=session)
+    location = f"{helpers.CENTRALIZED_LOCATION_PREFIX}/{image['id']}"
+    staged_location = f"{helpers.CENTRALIZED_STAGING_LOCATION_PREFIX}/{image['id']}"
+    locations = {
+        loc['url'] for loc in glance.images.get(image['id']).get('locations', [])
+    }
+    if location not in locations:
+        glance.images.add_location(
+            image['id'], location, {"store": helpers.CENTRALIZED_STORE}
+        )
+    if staged_location in locations:
+        glance.images.delete_locations(image['id'], {staged_location})
+    # the staged manifest goes last, so a retry still finds it
+    for obj in [segment['name'] for segment in segments] + [image['id']]:
+        helpers.call_with_retries(swift_conn.delete_object, staging, obj)
+    return True
+
+
+def copy_image_in_place(session, image_id, swift_conn=None, timeout=(60 * 30)):
+    """
+    Copy an image into the centralized store with Glance's copy-image
+    import, so the data never leaves the site, then drop its other
+    stores. Raises if the site does not support it or the copy fails.
+    """
+    glance = chi.glance(session=session)
+    import_methods = glance.images.get_import_info()["import-methods"]["value"]
+    if "copy-image" not in import_methods:
+        raise RuntimeError("copy-image import is not enabled")
+    image = glance.images.get(image_id)
+    old_stores = [
+        store for store in image.get("stores", "").split(",")
+        if store and store != helpers.CENTRALIZED_STORE
+    ]
+
+    glance.images.image_import(
+        image_id, method="copy-image", stores=[helpers.CENTRALIZED_STORE]
+    )
+
+    def _poll():
+        image = glance.images.get(image_id)
+        if helpers.CENTRALIZED_STORE in image.get("os_glance_failed_import", "").split(","):
+            return "failed"
+        if helpers.CENTRALIZED_STORE in image.get("stores", "").split(","):
+            return "copied"
+        return "copying"
+
+    waiter.wait_for(
+        f"copy of image {image_id}", _poll, {"copied"}, {"failed"}, timeout=timeout
+    )
+    for store in old_stores:
+        glance.images.delete_from_store(store, image_id)
+
+    image = glance.images.get(image_id)
+    set_swift_metadata(session, image, swift_conn)
+    return image
 
 
 def archive_image(auth_session, owner, image):
@@ -161,6 +345,107 @@ def archive_image(auth_session, owner, image):
     glance.images.update(image['id'], name=new_name)
 
 
+def is_released(image):
+    return (
+        image.get("stores", None) == helpers.CENTRALIZED_STORE and
+        image["visibility"] == "public"
+    )
+
+
+def latest_unreleased_images(glance, owner, identifiers):
+    """
+    The newest image of every identifier, unless it is already released,
+    found with a single listing.
+    """
+    identifiers = set(identifiers)
+    latest = {}
+    for image in glance.images.list(filters={'owner': owner, 'status': 'active'}):
+        identifier = (
+            image.get('build-distro'),
+            image.get('build-release'),
+            image.get('build-variant'),
+            image.get('build-ipa', 'na'),
+        )
+        if identifier not in identifiers:
+            continue
+        if identifier not in latest or image['created_at'] > latest[identifier]['created_at']:
+            latest[identifier] = image
+    return {
+        identifier: image for identifier, image in latest.items()
+        if not is_released(image)
+    }
+
+
+def publish_image(auth_sessions, owner, from_site, source_image, swift_conn=None):
+    """
+    Copy a staged image to the centralized store, archive the current
+    production image and make the new one production. Returns the new
+    image.
+    """
+    centralized_auth_session = auth_sessions[helpers.CENTRALIZED_STORE_SITE]
+    image_production_name = production_name(image=source_image)
+
+    # publish image; images uploaded straight from the builder are already
+    # in the centralized store
+    copied = False
+    if is_in_centralized_store(from_site, source_image):
+        print('image {} is already in the centralized store'.format(source_image['id']))
+        if release_staged_object(centralized_auth_session, source_image, swift_conn):
+            print('moved image {} out of the staging container'.format(source_image['id']))
+        new_image = source_image
+    elif from_site == helpers.CENTRALIZED_STORE_SITE:
+        try:
+            new_image = copy_image_in_place(
+                centralized_auth_session, source_image['id'], swift_conn
+            )
+            print('copied image {} to the centralized store on site'.format(
+                source_image['id']))
+        except Exception as e:
+            print(f'server-side copy failed ({e}), copying through this host',
+                  file=sys.stderr)
+            new_image = None
+    else:
+        new_image = None
+    if new_image is None:
+        new_image = copy_image(
+            auth_sessions[from_site], centralized_auth_session, source_image['id'],
+            swift_conn,
+        )
+        copied = True
+
+    # rename old image at centralized object store
+    glance = chi.glance(session=centralized_auth_session)
+    named_images = list(glance.images.list(filters={
+        'name': image_production_name,
+        'owner': owner,
+        'visibility': 'public',
+        'stores': helpers.CENTRALIZED_STORE}
+    ))
+    if len(named_images) == 1:
+        archive_image(centralized_auth_session, owner, named_images[0]['id'])
+    elif len(named_images) > 1:
+        raise RuntimeError(
+            'multiple images with the name "{}"'
+            .format(image_production_name))
+    elif len(named_images) < 1:
+        # do nothing
+        print(f"no public production images {image_production_name} found on site {helpers.CENTRALIZED_STORE_SITE}")
+
+    # rename new image at centralized object store
+    new_image = glance.images.update(new_image['id'],
+                                     name=image_production_name,
+                                     visibility='public',
+                                     )
+
+    # delete tmp image
+    if copied:
+        print('delete tmp image {} from site {}'.format(source_image['id'], from_site))
+        glance = chi.glance(session=auth_sessions[from_site])
+        glance.images.delete(source_image['id'])
+
+    return new_image
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
@@ -178,10 +463,16 @@ def main(argv=None):
     parser.add_argument('--latest', type=str, nargs=3,
                         metavar=('distro', 'release', 'variant'),
                         help='Publish latest tested image given 3 args:<distro> <release> <variant>')
+    parser.add_argument('--all-latest', action='store_true',
+                        help='Publish the latest unreleased image of every '
+                        'supported distro, release and variant')
     parser.add_argument('--ipa', type=str, default="na",
                         choices=['initramfs', 'kernel'],
                         help='IPA metadata; if not IPA image, set to "na"; default "na"')
     parser.add_argument('--image', type=str, help='Image id to publish')
+    parser.add_argument('--concurrency', type=int, default=2,
+                        help='Images to publish at the same time with '
+                        '--all-latest; default 2')
     parser.add_argument('--notify', type=str, nargs=2,
                         help="Send notifications to emails (comma-separated)"
                         " using relay: <relay> <emails>")
@@ -196,14 +487,13 @@ def main(argv=None):
         if site in helpers.CHAMELEON_CORE_SITES:
             auth_sessions[site] = helpers.get_auth_session_from_rc(auth_info)
 
-    centralized_auth_session = auth_sessions[helpers.CENTRALIZED_STORE_SITE]
-
+    owner = auth_data['auths'][args.from_site]['OS_PROJECT_ID']
     glance_source = chi.glance(session=auth_sessions[args.from_site])
 
     if args.image:
-        source_image = glance_source.get(args.image)
+        source_images = [glance_source.images.get(args.image)]
         print('found specified image {} ({}) to publish'.format(
-            source_image['name'], source_image['id']))
+            source_images[0]['name'], source_images[0]['id']))
     elif args.latest:
         distro, release, variant = args.latest
         query = {
@@ -223,66 +513,65 @@ def main(argv=None):
                 f"No latest image found with query {query}"
             )
             return 0
-        if latest_image.get("stores", None) == helpers.CENTRALIZED_STORE:
+        if is_released(latest_image):
             print(
                 f"The latest {distro}-{release} {variant} image has been released.",
                 file=sys.stderr
             )
             return 0
-        source_image = latest_image
+        source_images = [latest_image]
         print('found latest image {} ({}) to publish'.format(
-            source_image['name'], source_image['id']))
+            latest_image['name'], latest_image['id']))
+    elif args.all_latest:
+        latest = latest_unreleased_images(
+            glance_source, owner, catalog.load().identifiers
+        )
+        source_images = [latest[identifier] for identifier in sorted(latest)]
+        for image in source_images:
+            print('found latest image {} ({}) to publish'.format(
+                image['name'], image['id']))
+        if not source_images:
+            print("All latest images have been released.", file=sys.stderr)
+            return 0
     else:
-        print('must provide --latest or --image', file=sys.stderr)
+        print('must provide --latest, --all-latest or --image', file=sys.stderr)
         return 1
 
-    image_production_name = production_name(image=source_image)
+    swift_conn = SharedSwiftConnection(auth_sessions[helpers.CENTRALIZED_STORE_SITE])
 
-    # publish image
-    new_image = copy_image(
-        auth_sessions[args.from_site], centralized_auth_session, source_image['id']
-    )
-
-    # rename old image at centralized object store
-    glance = chi.glance(session=centralized_auth_session)
-    named_images = list(glance.images.list(filters={
-        'name': image_production_name,
-        'owner': auth_data['auths'][args.from_site]['OS_PROJECT_ID'],
-        'visibility': 'public',
-        'stores': helpers.CENTRALIZED_STORE}
-    ))
-    if len(named_images) == 1:
-        archive_image(centralized_auth_session, auth_data['auths'][args.from_site]
-                      ['OS_PROJECT_ID'], named_images[0]['id'])
-    elif len(named_images) > 1:
-        raise RuntimeError(
-            'multiple images with the name "{}"'
-            .format(image_production_name))
-    elif len(named_images) < 1:
-        # do nothing
-        print(f"no public production images {image_production_name} found on site {helpers.CENTRALIZED_STORE_SITE}")
-
-    # rename new image at centralized object store
-    glance = chi.glance(session=centralized_auth_session)
-    new_image = glance.images.update(new_image['id'],
-                                     name=image_production_name,
-                                     visibility='public',
-                                     )
+    def _publish(source_image):
+        try:
+            return publish_image(
+                auth_sessions, owner, args.from_site, source_image, swift_conn
+            )
+        except Exception as e:
+            print('failed to publish image {} ({}): {}'.format(
+                source_image['name'], source_image['id'], e), file=sys.stderr)
+            return None
 
-    # delete tmp image
-    print('delete tmp image {} from site {}'.format(source_image['id'], args.from_site))
-    glance = chi.glance(session=auth_sessions[args.from_site])
-    glance.images.delete(source_image['id'])
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(_publish, source_images))
+    new_images = [image for image in results if image is not None]
 
-    if args.notify:
+    if args.notify and new_images:
         relay, to_emails = args.notify
         print(f"sending emails to {to_emails}")
-        helpers.send_notification_mail(
-            relay,
-            "no-reply@chameleoncloud.org",
-            to_emails.split(","),
-            new_image
-        )
+        if len(new_images) == 1:
+            helpers.send_notification_mail(
+                relay,
+                "no-reply@chameleoncloud.org",
+                to_emails.split(","),
+                new_images[0]
+            )
+        else:
+            helpers.send_digest_mail(
+                relay,
+                "no-reply@chameleoncloud.org",
+                to_emails.split(","),
+                new_images
+            )
+
+    return 0 if len(new_images) == len(source_images) else 1
 
 
 if __name__ == '__main__':
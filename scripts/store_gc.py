@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+'''
+Garbage collect the centralized object store.
+
+Two kinds of garbage are collected:
+
+  * versions in the supported images container
+    ({scope}/versions/{version}/...) that are not referenced by any scope's
+    `current` pointer, keeping the newest --keep-versions per scope;
+  * DLO segment objects in the images container ({image_id}-00001, ...)
+    that are no longer referenced by any `x-object-manifest`.
+
+Objects are removed with the Swift bulk-delete middleware when the cluster
+supports it.
+
+JSON auth file should be of format:
+
+    {"auths": {"<site1>": {"<OS_var>": "<value>", ...}, ...}}
+'''
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import re
+import sys
+import threading
+from urllib.parse import quote
+
+sys.path.append("..")
+from utils import helpers
+
+
+SUPPORTED_IMAGES_CONTAINER_NAME = "chameleon-supported-images"
+BULK_DELETE_BATCH_SIZE = 1000
+
+UUID_PATTERN = "[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+SEGMENT_RE = re.compile(f"^{UUID_PATTERN}-\\d+$")
+MANIFEST_RE = re.compile(f"^{UUID_PATTERN}$")
+
+
+class SwiftConnections:
+    """
+    swiftclient connections are not thread-safe; hand out one per thread,
+    all sharing the same auth session.
+    """
+
+    def __init__(self, session, region_name):
+        self.session = session
+        self.region_name = region_name
+        self._local = threading.local()
+
+    def get(self):
+        if not hasattr(self._local, "conn"):
+            self._local.conn = helpers.connect_to_swift_with_admin(
+                self.session, self.region_name
+            )
+        return self._local.conn
+
+
+def parse_last_modified(obj):
+    return datetime.datetime.strptime(
+        obj["last_modified"][:19], "%Y-%m-%dT%H:%M:%S"
+    )
+
+
+def find_unreferenced_versions(swift_conn, container, keep_versions):
+    """
+    Return the object names of every version that no scope's `current`
+    pointer references and that is not among the newest keep_versions of
+    its scope.
+    """
+    _, top_level = swift_conn.get_container(
+        container, delimiter="/", full_listing=True
+    )
+    scopes = [item["subdir"].rstrip("/") for item in top_level if "subdir" in item]
+
+    current_pointers = {}
+    for scope in scopes:
+        try:
+            _, content = swift_conn.get_object(container, f"{scope}/current")
+        except Exception as e:
+            if helpers.get_http_status(e) == 404:
+                continue
+            raise
+        current_pointers[scope] = json.loads(content)
+    referenced = {
+        version
+        for current in current_pointers.values()
+        for version in current.values()
+    }
+
+    garbage = []
+    for scope in current_pointers:
+        prefix = f"{scope}/versions/"
+        _, objects = swift_conn.get_container(
+            container, prefix=prefix, full_listing=True
+        )
+        versions = {}
+        for obj in objects:
+            version = obj["name"][len(prefix):].split("/", 1)[0]
+            versions.setdefault(version, []).append(obj)
+
+        newest_first = sorted(
+            versions,
+            key=lambda v: max(parse_last_modified(o) for o in versions[v]),
+            reverse=True,
+        )
+        for version in newest_first[keep_versions:]:
+            if version in referenced:
+                continue
+            print(f"version {scope}/{version} is unreferenced "
+                  f"({len(versions[version])} objects)")
+            garbage.extend(f"{container}/{o['name']}" for o in versions[version])
+
+    return garbage
+
+
+def find_orphan_segments(swift_connections, container, min_age_hours, concurrency):
+    """
+    Return the object names of segments that no manifest references.
+    Segments younger than min_age_hours are skipped since an upload in
+    progress writes its segments before the manifest.
+    """
+    _, objects = swift_connections.get().get_container(container, full_listing=True)
+
+    manifests = [o["name"] for o in objects if MANIFEST_RE.match(o["name"])]
+
+    def _manifest_prefix(name):
+        headers = swift_connections.get().head_object(container, name)
+        return headers.get("x-object-manifest", None)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        prefixes = [
+            p for p in executor.map(_manifest_prefix, manifests) if p
+        ]
+    prefixes = tuple(
+        p.split("/", 1)[1] for p in prefixes
+        if p.split("/", 1)[0] == container
+    )
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=min_age_hours)
+    garbage = []
+    for obj in objects:
+        if not SEGMENT_RE.match(obj["name"]):
+            continue
+        if obj["name"].startswith(prefixes):
+            continue
+        if parse_last_modified(obj) > cutoff:
+            continue
+        garbage.append(f"{container}/{obj['name']}")
+
+    print(f"found {len(garbage)} orphan segments in {container}")
+    return garbage
+
+
+def bulk_delete(swift_connections, paths, concurrency):
+    """
+    Delete container/object paths in batches, using the bulk-delete
+    middleware if available and one DELETE per object otherwise.
+    """
+    capabilities = swift_connections.get().get_capabilities()
+    use_bulk = "bulk_delete" in capabilities
+    batch_size = BULK_DELETE_BATCH_SIZE
+    if use_bulk:
+        batch_size = min(
+            batch_size,
+            capabilities["bulk_delete"].get("max_deletes_per_request", batch_size),
+        )
+
+    def _delete_batch(batch):
+        conn = swift_connections.get()
+        if not use_bulk:
+            for path in batch:
+                container, obj = path.split("/", 1)
+                helpers.call_with_retries(conn.delete_object, container, obj)
+            return len(batch), []
+        _, body = helpers.call_with_retries(
+            conn.post_account,
+            headers={"Content-Type": "text/plain", "Accept": "application/json"},
+            query_string="bulk-delete",
+            data="\n".join(quote(f"/{path}") for path in batch).encode(),
+        )
+        result = json.loads(body)
+        return result["Number Deleted"], result["Errors"]
+
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    deleted = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch_deleted, batch_errors in executor.map(_delete_batch, batches):
+            deleted += batch_deleted
+            errors.extend(batch_errors)
+
+    print(f"deleted {deleted} of {len(paths)} objects")
+    for error in errors:
+        print(f"failed to delete {error}", file=sys.stderr)
+    return not errors
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    parser.add_argument('auth_jsons', type=str,
+                        help='File with auth info in JSON format for core sites.')
+    parser.add_argument('--site', type=str,
+                        default=helpers.CENTRALIZED_STORE_SITE,
+                        help='Site hosting the containers')
+    parser.add_argument('--region-name', type=str,
+                        default=helpers.CENTRALIZED_STORE_REGION_NAME,
+                        help='Region name of the site hosting the containers')
+    parser.add_argument('--versions-container', type=str,
+                        default=SUPPORTED_IMAGES_CONTAINER_NAME,
+                        help='Container with {scope}/versions/ and {scope}/current')
+    parser.add_argument('--images-container', type=str,
+                        default=helpers.CENTRALIZED_CONTAINER_NAME,
+                        help='Container with image objects and their segments')
+    parser.add_argument('--only', type=str, choices=['versions', 'segments'],
+                        help='Only collect one kind of garbage')
+    parser.add_argument('--keep-versions', type=int, default=3,
+                        help='Unreferenced versions to keep per scope; default 3')
+    parser.add_argument('--min-segment-age-hours', type=int, default=24,
+                        help='Never delete segments younger than this; default 24')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Number of concurrent Swift requests; default 8')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only print what would be deleted')
+
+    args = parser.parse_args(argv[1:])
+
+    if args.keep_versions < 1:
+        # the newest version may still be uploading before `current` moves
+        parser.error("--keep-versions must be at least 1")
+
+    with open(args.auth_jsons) as f:
+        auth_data = json.load(f)
+
+    session = helpers.get_auth_session_from_rc(auth_data['auths'][args.site])
+    swift_connections = SwiftConnections(session, args.region_name)
+
+    garbage = []
+    if args.only in (None, 'versions'):
+        garbage.extend(find_unreferenced_versions(
+            swift_connections.get(), args.versions_container, args.keep_versions
+        ))
+    if args.only in (None, 'segments'):
+        garbage.extend(find_orphan_segments(
+            swift_connections, args.images_container,
+            args.min_segment_age_hours, args.concurrency,
+        ))
+
+    if not garbage:
+        print("nothing to collect")
+        return 0
+
+    if args.dry_run:
+        for path in garbage:
+            print(f"would delete {path}")
+        return 0
+
+    return 0 if bulk_delete(swift_connections, garbage, args.concurrency) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
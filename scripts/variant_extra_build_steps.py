@@ -10,8 +10,6 @@ class ExtraSteps:
         region = kwargs["region"]
         ip = kwargs["ip"]
         rc = kwargs["rc"]
-        ssh_key_file = kwargs["ssh_key_file"]
-        ssh_args = kwargs["ssh_args"]
 
         tmp_fpga_dir = '/tmp/fpga'
         session = helpers.get_auth_session_from_rc(rc)
@@ -34,28 +32,11 @@ class ExtraSteps:
             resp_headers, obj_contents = swift_connection.get_object('FPGA', obj)
             with open('{}/{}'.format(tmp_fpga_dir, obj), 'wb') as local:
                 local.write(obj_contents)
-            if ssh_key_file:
-                proc = helpers.run('scp -i {} {} {}/{} cc@{}:'
-                                   .format(ssh_key_file,
-                                           ' '.join(
-                                               ssh_args),
-                                           tmp_fpga_dir,
-                                           obj, ip))
-            else:
-                proc = helpers.run(
-                    'scp {} {}/{} cc@{}:'.format(' '.join(ssh_args),
-                                                 tmp_fpga_dir,
-                                                 obj, ip))
-            print(' - stdout:\n{}\n - stderr:\n{}\n--------'.format(
-                proc.stdout, proc.stderr
-            ))
-            if proc.returncode != 0:
-                raise RuntimeError('scp to remote failed!')
-            else:
-                helpers.remote_run(
-                    ip=ip, command='sudo mv ~/{} {}/'.format(obj, tmp_fpga_dir))
-                helpers.remote_run(
-                    ip=ip, command='sudo chmod -R 755 {}'.format(tmp_fpga_dir))
+            helpers.remote_put(ip, '{}/{}'.format(tmp_fpga_dir, obj))
+            helpers.remote_run(
+                ip=ip, command='sudo mv ~/{} {}/'.format(obj, tmp_fpga_dir))
+            helpers.remote_run(
+                ip=ip, command='sudo chmod -R 755 {}'.format(tmp_fpga_dir))
 
         # clean up
         helpers.run('rm -rf {}'.format(tmp_fpga_dir))
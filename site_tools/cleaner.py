@@ -4,10 +4,12 @@ Clean up older versions of the images in Glance.
 '''
 import argparse
 import chi
-from datetime import date, datetime
-from dateutil.relativedelta import relativedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import json
 import logging
+import operator
+import os
 import shlex
 import subprocess
 import sys
@@ -16,53 +18,253 @@ import ulid
 from urllib.parse import urlparse
 import yaml
 
-from utils import helpers
+from site_tools import retention
+from utils import catalog, helpers
 
 logging.basicConfig(level=logging.INFO)
 
+INVENTORY_PROPS = [
+    "id",
+    "name",
+    "created_at",
+    "size",
+    "stores",
+    "visibility",
+    "build-distro",
+    "build-release",
+    "build-variant",
+    "build-ipa",
+]
+STATE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
-def production_name(supports, distro, release, variant):
 
-    prod_name = supports["supported_distros"][distro]["releases"][release]["prod_name"]
-    suffix = supports["supported_variants"][variant]["prod_name_suffix"]
+def get_identifier(image):
+    return (
+        image["build-distro"],
+        image.get("build-release"),
+        image.get("build-variant"),
+        image.get("build-ipa", "na"),
+    )
+
+
+def group_images(images):
+    """
+    Group the Chameleon-built images by
+    (build-distro, build-release, build-variant, build-ipa).
+    """
+    groups = {}
+    for img in images:
+        if "build-distro" not in img:
+            continue
+        groups.setdefault(get_identifier(img), []).append(img)
+    return groups
+
+
+def inventory_record(img):
+    """
+    The subset of an image's properties the cleaner needs, as kept in the
+    incremental state file.
+    """
+    return {k: img[k] for k in INVENTORY_PROPS if k in img}
 
-    if suffix:
-        prod_name = f"{prod_name}-{suffix}"
 
-    return prod_name
+def load_state(state_file):
+    if not state_file or not os.path.exists(state_file):
+        return None
+    with open(state_file, "r") as f:
+        return json.load(f)
 
 
-def get_in_use_image_ids(novaclient):
-    active_servers = novaclient.servers.list(
-        search_opts={"status": "ACTIVE", "all_tenants": "yes"},
+def save_state(state_file, state):
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_file, state_file)
+
+
+def update_inventory(glanceclient, state):
+    """
+    Apply the Glance changes since the previous run to its inventory.
+    Returns the new inventory and the identifiers of the groups touched
+    by those changes.
+    """
+    inventory = dict(state["inventory"])
+    changed_groups = set()
+    changed = glanceclient.images.list(filters={
+        "updated_at": f"gt:{state['last_run']}",
+        "visibility": "all",
+    })
+    for img in changed:
+        old = inventory.pop(img["id"], None)
+        if old and "build-distro" in old:
+            changed_groups.add(get_identifier(old))
+        if img["visibility"] == "public" and "build-distro" in img:
+            inventory[img["id"]] = inventory_record(img)
+            changed_groups.add(get_identifier(img))
+    logging.info(
+        f"{len(changed_groups)} image groups changed since {state['last_run']}."
     )
-    return set([s.image["id"] for s in active_servers])
+    return inventory, changed_groups
+
 
+def reconcile_inventory(glanceclient, inventory, identifiers):
+    """
+    Drop the images of the given groups that no longer exist. Deleted
+    images never show up as changed, so ones deleted outside the cleaner
+    are found by listing each group, one call per group.
+    """
+    for identifier in identifiers:
+        distro, release, variant, _ = identifier
+        filters = {"visibility": "public", "build-distro": distro}
+        if release is not None:
+            filters["build-release"] = release
+        if variant is not None:
+            filters["build-variant"] = variant
+        existing = {
+            img["id"] for img in glanceclient.images.list(filters=filters)
+            if get_identifier(img) == identifier
+        }
+        for image_id, img in list(inventory.items()):
+            if get_identifier(img) == identifier and image_id not in existing:
+                logging.info(f"Image {img['name']} (id: {image_id}) no longer exists.")
+                del inventory[image_id]
 
-def find_images(glanceclient, novaclient, distro, release, variant, prod_name):
-    query = {
-        "build-distro": distro,
-        "build-release": release,
-        "build-variant": variant,
-        "visibility": "public",
-    }
 
-    images_in_use = get_in_use_image_ids(novaclient)
+def get_in_use_image_ids(novaclient, ironicclient=None, page_size=1000):
+    """
+    Snapshot the ids of every image currently in use on the site: images
+    of ACTIVE instances across all tenants and, if an Ironic client is
+    given, the deploy kernels/ramdisks referenced by node driver_info.
+
+    Build it once per run and share it across all matching.
+    """
+    images_in_use = set()
+
+    marker = None
+    while True:
+        servers = novaclient.servers.list(
+            search_opts={"status": "ACTIVE", "all_tenants": "yes"},
+            marker=marker,
+            limit=page_size,
+        )
+        for s in servers:
+            # volume-backed instances have no image
+            if s.image:
+                images_in_use.add(s.image["id"])
+        # a page can come back shorter than asked for when Nova's
+        # osapi_max_limit is lower, so only an empty page is the end
+        if not servers:
+            break
+        marker = servers[-1].id
+
+    if ironicclient:
+        for node in ironicclient.node.list(fields=["uuid", "driver_info"], limit=0):
+            for key in ("deploy_kernel", "deploy_ramdisk"):
+                if node.driver_info.get(key):
+                    images_in_use.add(node.driver_info[key])
+
+    return images_in_use
+
+
+def find_images(images, images_in_use, prod_name):
+    """
+    Filter a group of images down to the ones eligible for hiding or
+    deleting. When the group's production name is unknown (the identifier
+    is no longer in supports.yaml), its newest image is kept instead.
+    Returns the eligible images and those skipped for being in use.
+    """
+    newest_image = None
+    if prod_name is None:
+        newest_image = max(images, key=operator.itemgetter("created_at"))
 
     matching_images = []
-    for img in glanceclient.images.list(filters=query):
+    in_use_images = []
+    for img in images:
         # exclude the latest version with prod name
-        if img["name"] == prod_name:
+        if img["name"] == prod_name or img is newest_image:
             continue
         # exclude ones that in use at the moment
         if img["id"] in images_in_use:
             logging.info(
                 f"Some active instances are using Image {img['name']} (id: {img['id']})."
             )
+            in_use_images.append(img)
             continue
         matching_images.append(img)
 
-    return matching_images
+    return matching_images, in_use_images
+
+
+def run_action(glanceclient, action, img, dry_run=False):
+    if action == "delete":
+        if not dry_run:
+            glanceclient.images.delete(img['id'])
+        logging.info(f"Image {img['name']} (id: {img['id']}) has been deleted.")
+    elif action == "hide":
+        if not dry_run:
+            glanceclient.images.update(
+                img['id'], visibility='private',
+            )
+        logging.info(f"Image {img['name']} (id: {img['id']}) has been hided.")
+    else:
+        raise ValueError(f"Unknown action {action}")
+
+
+def execute_actions(glanceclient, actions, concurrency=8, rate=5, dry_run=False):
+    """
+    Run (action, image) pairs with bounded concurrency, at most ``rate``
+    Glance calls per second, retrying conflicts and server errors with
+    backoff. Returns a report per image group.
+    """
+    rate_limiter = helpers.RateLimiter(rate)
+    report = {}
+
+    def _run(action, img):
+        helpers.call_with_retries(
+            run_action, glanceclient, action, img,
+            dry_run=dry_run, rate_limiter=rate_limiter,
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [
+            (action, img, executor.submit(_run, action, img))
+            for action, img in actions
+        ]
+        for action, img, future in futures:
+            group = report.setdefault(get_identifier(img), {
+                "deleted": 0, "hidden": 0, "failed": 0, "bytes_reclaimed": 0,
+                "failed_ids": [],
+            })
+            try:
+                future.result()
+            except Exception as e:
+                if helpers.get_http_status(e) == 404:
+                    logging.info(f"Image {img['name']} (id: {img['id']}) no longer exists.")
+                    continue
+                logging.exception(f"Failed to {action} {img['name']} (id: {img['id']}).")
+                group["failed"] += 1
+                group["failed_ids"].append(img["id"])
+                continue
+            if action == "delete":
+                group["deleted"] += 1
+                group["bytes_reclaimed"] += img.get("size") or 0
+            else:
+                group["hidden"] += 1
+
+    return report
+
+
+def log_report(report):
+    total = 0
+    for identifier, group in sorted(report.items(), key=lambda i: str(i[0])):
+        logging.info(
+            f"{'-'.join(str(i) for i in identifier)}: "
+            f"deleted {group['deleted']}, hidden {group['hidden']}, "
+            f"failed {group['failed']}, "
+            f"reclaimed {group['bytes_reclaimed'] / 2**30:.2f} GiB"
+        )
+        total += group["bytes_reclaimed"]
+    logging.info(f"Total reclaimed: {total / 2**30:.2f} GiB")
 
 
 def main(argv=None):
@@ -76,71 +278,126 @@ def main(argv=None):
 
     parser.add_argument("--site-yaml", type=str, required=True,
                         help="A yaml file with site credentials.")
+    parser.add_argument("--supports-yaml", type=str, default=catalog.SITE_PATH,
+                        help="A yaml file with supported images.")
     parser.add_argument("--dry-run", action='store_true',
                         help="Dry run; no actual hiding and deleting")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Number of hide/delete actions to run at the same time; default 8")
+    parser.add_argument("--rate-limit", type=float, default=5,
+                        help="Maximum Glance hide/delete calls per second; default 5")
+    parser.add_argument("--state-file", type=str,
+                        help="Run incrementally, keeping the image inventory "
+                        "of the previous run in this file")
+    parser.add_argument("--full-every-hours", type=int, default=168,
+                        help="With --state-file, re-evaluate every image from scratch "
+                        "when the last full run is older than this; default 168")
 
     args = parser.parse_args(argv[1:])
 
-    with open("/etc/chameleon_image_tools/supports.yaml", 'r') as f:
-        supports = yaml.safe_load(f)
+    supports = catalog.load(args.supports_yaml)
 
     with open(args.site_yaml, 'r') as f:
         site_specs = yaml.safe_load(f)
-    hide_image_age_in_month = site_specs["hide_image_age_in_month"]
-    delete_image_age_in_month = site_specs["delete_image_age_in_month"]
-    if hide_image_age_in_month >= delete_image_age_in_month:
-        raise ValueError(
-            "Parameter hide_image_age_in_month must be smaller than delete_image_age_in_month"
-        )
-
-    today = date.today()
-    hide_datetime_cutoff = today + relativedelta(months=-hide_image_age_in_month)
-    delete_datetime_cuttoff = today + relativedelta(months=-delete_image_age_in_month)
+    retention.validate_policy(site_specs)
 
     auth_session = helpers.get_auth_session_from_yaml(args.site_yaml)
     glance = chi.glance(session=auth_session)
     nova = chi.nova(session=auth_session)
+    ironic = chi.ironic(session=auth_session)
 
-    ready_to_delete_images = []
-    for distro, dv in supports["supported_distros"].items():
-        if "releases" not in dv:
+    now = datetime.utcnow()
+    state = load_state(args.state_file)
+    if state and now - datetime.strptime(
+        state["last_full_run"], STATE_TIME_FORMAT
+    ) < timedelta(hours=args.full_every_hours):
+        inventory, affected = update_inventory(glance, state)
+        last_run_date = datetime.strptime(state["last_run"], STATE_TIME_FORMAT).date()
+        last_full_run = state["last_full_run"]
+    else:
+        logging.info("Evaluating every public image.")
+        inventory = {
+            img["id"]: inventory_record(img)
+            for img in glance.images.list(filters={"visibility": "public"})
+            if "build-distro" in img
+        }
+        affected = None
+        last_run_date = None
+        last_full_run = now.strftime(STATE_TIME_FORMAT)
+
+    groups = group_images(inventory.values())
+    if affected is not None:
+        # images skipped as in use may have been freed since
+        affected.update(tuple(i) for i in state.get("in_use_groups", []))
+        # time alone moves images past the age cutoffs
+        affected.update(
+            identifier for identifier, images in groups.items()
+            if any(
+                retention.crossed_age_cutoff(img, site_specs, last_run_date)
+                for img in images
+            )
+        )
+        # storage budgets are shared by all groups
+        if affected and retention.storage_budgets(site_specs):
+            affected = set(groups)
+        logging.info(f"Re-evaluating {len(affected)} of {len(groups)} image groups.")
+        # ghosts would take keep-last slots and count against budgets
+        reconcile_inventory(glance, inventory, affected)
+        groups = group_images(inventory.values())
+
+    candidates = {}
+    in_use_groups = []
+    if affected is None or affected:
+        images_in_use = get_in_use_image_ids(nova, ironic)
+        logging.info(f"Found {len(images_in_use)} images in use.")
+    for identifier, images in groups.items():
+        if affected is not None and identifier not in affected:
             continue
-        releases = dv["releases"]
-        for release, rv in releases.items():
-            if "variants" not in rv:
-                continue
-            for variant in rv["variants"]:
-                prod_name = production_name(supports, distro, release, variant)
-                ready_to_delete_images.extend(find_images(
-                    glance, nova, distro, release, variant, prod_name
-                ))
+        try:
+            prod_name = supports.production_name(*identifier)
+        except KeyError:
+            logging.info(
+                f"{identifier} is not in supports.yaml; keeping its newest image."
+            )
+            prod_name = None
+        candidates[identifier], in_use = find_images(images, images_in_use, prod_name)
+        if in_use:
+            in_use_groups.append(identifier)
 
-    skip_images = []
     if args.dry_run:
         logging.info("It's dry-run. Print messages only.")
-    if "skip_images" in site_specs:
-        skip_images = site_specs["skip_images"]
-    for img in ready_to_delete_images:
-        if img["id"] in skip_images:
-            logging.info(f"Skip image {img['name']} (id: {img['id']}).")
-            continue
-        create_date = datetime.strptime(img["created_at"], "%Y-%m-%dT%H:%M:%SZ").date()
-        if create_date <= delete_datetime_cuttoff:
-            try:
-                if not args.dry_run:
-                    glance.images.delete(img['id'])
-                logging.info(f"Image {img['name']} (id: {img['id']}) has been deleted.")
-            except Exception:
-                logging.exception(f"Failed to delete {img['name']} (id: {img['id']}).")
-        elif create_date <= hide_datetime_cutoff:
-            try:
-                if not args.dry_run:
-                    glance.images.update(
-                        img['id'], visibility='private',
-                    )
-                logging.info(f"Image {img['name']} (id: {img['id']}) has been hided.")
-            except Exception:
-                logging.exception(f"Failed to hide {img['name']} (id: {img['id']}).")
+    skip_images = site_specs.get("skip_images", [])
+    for images in candidates.values():
+        for img in images:
+            if img["id"] in skip_images:
+                logging.info(f"Skip image {img['name']} (id: {img['id']}).")
+
+    plan = retention.build_plan(groups, candidates, site_specs, skip_images)
+    retention.log_plan(plan)
+    actions = [(action, img) for action, img, _ in plan]
+
+    report = execute_actions(
+        glance, actions,
+        concurrency=args.concurrency,
+        rate=args.rate_limit,
+        dry_run=args.dry_run,
+    )
+    log_report(report)
+
+    if args.state_file and not args.dry_run:
+        failed_ids = {
+            image_id for group in report.values() for image_id in group["failed_ids"]
+        }
+        for action, img, _ in plan:
+            if img["id"] not in failed_ids:
+                inventory.pop(img["id"], None)
+        save_state(args.state_file, {
+            "last_run": now.strftime(STATE_TIME_FORMAT),
+            "last_full_run": last_full_run,
+            "inventory": inventory,
+            # re-evaluated every run until their images are freed
+            "in_use_groups": in_use_groups,
+        })
 
 
 if __name__ == '__main__':
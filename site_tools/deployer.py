@@ -4,19 +4,24 @@ Download image from the centralized object store and deploy to the site.
 '''
 import argparse
 import chi
-import io
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import operator
 import re
 import requests
 import sys
+import threading
 import ulid
-import yaml
 
-from utils import helpers
+from utils import catalog, helpers
 
 logging.basicConfig(level=logging.INFO)
 
+# archive/rename of a production name must never interleave between two
+# publish pipelines, so each name gets its own lock
+_production_name_locks = {}
+_production_name_locks_guard = threading.Lock()
+
 
 def get_identifiers(headers):
     distro = headers[f"{helpers.SWIFT_META_HEADER_PREFIX}build-distro"]
@@ -27,20 +32,6 @@ def get_identifiers(headers):
     return distro, release, variant, ipa
 
 
-def production_name(headers, supports):
-    distro, release, variant, ipa = get_identifiers(headers)
-
-    prod_name = supports["supported_distros"][distro]["releases"][release]["prod_name"]
-    suffix = supports["supported_variants"][variant]["prod_name_suffix"]
-
-    if suffix:
-        prod_name = f"{prod_name}-{suffix}"
-    if ipa != "na":
-        prod_name = f"{prod_name}.{ipa}"
-
-    return prod_name
-
-
 def find_latest_published_image(glanceclient, headers, image_production_name):
     distro, release, variant, ipa = get_identifiers(headers)
     query = {
@@ -58,7 +49,14 @@ def find_latest_published_image(glanceclient, headers, image_production_name):
     return next(iter(matching_images), None)
 
 
-def copy_image(session, headers, source_image_content):
+def production_name_lock(image_production_name):
+    with _production_name_locks_guard:
+        if image_production_name not in _production_name_locks:
+            _production_name_locks[image_production_name] = threading.Lock()
+        return _production_name_locks[image_production_name]
+
+
+def copy_image(session, headers, source_image_stream):
     glance = chi.glance(session=session)
     extra = {
         k.lower().replace(f"{helpers.SWIFT_META_HEADER_PREFIX}", ""): v
@@ -78,7 +76,7 @@ def copy_image(session, headers, source_image_content):
     try:
         glance.images.upload(
             new_image['id'],
-            io.BytesIO(source_image_content),
+            source_image_stream,
         )
     except Exception as e:
         # will raise exception if deleting fails; in this case, please
@@ -101,8 +99,16 @@ def archive_image(auth_session, image, image_production_name):
 
 
 def download_image(image_id):
-    r = requests.get(f"{helpers.CENTRALIZED_CONTAINER_URL}/{image_id}")
-    return r.headers, r.content
+    """
+    Open a streaming download of the image object. The caller owns the
+    returned response and must close it once the body has been consumed.
+    """
+    r = requests.get(
+        f"{helpers.CENTRALIZED_CONTAINER_URL}/{image_id}", stream=True
+    )
+    r.raise_for_status()
+    r.raw.decode_content = True
+    return r
 
 
 def read_image_metadata(image_id):
@@ -119,14 +125,6 @@ def list_images():
     return result
 
 
-def get_image_obj_by_id(image_id):
-    try:
-        return download_image(image_id)
-    except Exception:
-        logging.exception(f"Failed to download image {image_id}.")
-        return None, None
-
-
 def get_latest_image_objs(identifiers):
     image_objs = {}
     for image in list_images():
@@ -145,11 +143,77 @@ def get_latest_image_objs(identifiers):
                     "timestamp": timestamp, "obj": image
                 }
 
-    result = []
-    for identifier in image_objs.keys():
-        logging.info(f"Downloading image for {identifier}")
-        resp_headers, content = download_image(image_objs[identifier]["obj"])
-        yield (resp_headers, content)
+    return [image_objs[identifier]["obj"] for identifier in image_objs.keys()]
+
+
+def publish_image(auth_session, supports, image_id):
+    """
+    Publish a single image object: stream it from the centralized object
+    store into Glance, archive the current production image and promote
+    the new one.
+    """
+    glance = chi.glance(session=auth_session)
+
+    logging.info(f"Downloading image {image_id}")
+    with download_image(image_id) as resp:
+        resp_headers = resp.headers
+        image_production_name = supports.production_name(*get_identifiers(resp_headers))
+
+        # check if the latest image has been published
+        latest_image = find_latest_published_image(
+            glance, resp_headers, image_production_name
+        )
+        timestamp_header = f"{helpers.SWIFT_META_HEADER_PREFIX}build-timestamp"
+        revision_header = f"{helpers.SWIFT_META_HEADER_PREFIX}build-os-base-image-revision"
+        if (
+            latest_image and
+            latest_image.get("build-timestamp", None) == resp_headers[timestamp_header] and
+            latest_image.get("build-os-base-image-revision", None) == resp_headers[revision_header]
+        ):
+            d, r, v, p = get_identifiers(resp_headers)
+            logging.info(
+                f"The latest image {d}-{r}-{v}-{p} has been released. Nothing to do."
+            )
+            return None
+
+        # publish image
+        new_image = copy_image(auth_session, resp_headers, resp.raw)
+
+    with production_name_lock(image_production_name):
+        archived = None
+        try:
+            # rename old image
+            named_images = list(glance.images.list(filters={
+                'name': image_production_name,
+                'visibility': 'public'}
+            ))
+            if len(named_images) == 1:
+                archive_image(auth_session, named_images[0], image_production_name)
+                archived = named_images[0]
+            elif len(named_images) > 1:
+                raise RuntimeError(
+                    'multiple images with the name "{}"'
+                    .format(image_production_name))
+            elif len(named_images) < 1:
+                # do nothing
+                logging.info(f"no public production images {image_production_name} found on site")
+
+            # rename new image
+            glance.images.update(
+                new_image["id"],
+                name=image_production_name,
+                visibility="public",
+            )
+        except Exception:
+            # put the old production image back and drop the copy; the
+            # next run copies it again
+            if archived:
+                glance.images.update(archived["id"], name=image_production_name)
+            glance.images.delete(new_image["id"])
+            raise
+    logging.info(f"{image_production_name} has been published successfully!")
+
+    return new_image
 
 
 def main(argv=None):
@@ -163,7 +227,7 @@ def main(argv=None):
 
     parser.add_argument("--site-yaml", type=str, required=True,
                         help="A yaml file with site credentials.")
-    parser.add_argument("--supports-yaml", type=str, default="/etc/chameleon_image_tools/supports.yaml",
+    parser.add_argument("--supports-yaml", type=str, default=catalog.SITE_PATH,
                         help="A yaml file with supported images.")
     parser.add_argument('--latest', type=str, nargs=3,
                         metavar=("distro", "release", "variant"),
@@ -173,20 +237,17 @@ def main(argv=None):
                         help='IPA metadata; if not IPA image, set to "na"; default "na"')
     parser.add_argument('--image', type=str, help='Image id to publish')
 
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Number of images to publish at the same time; default 4')
+
     args = parser.parse_args(argv[1:])
 
-    with open(args.supports_yaml, 'r') as f:
-        supports = yaml.safe_load(f)
+    supports = catalog.load(args.supports_yaml)
 
     auth_session = helpers.get_auth_session_from_yaml(args.site_yaml)
 
-    release_images = []
-
     if args.image:
-        headers, content = get_image_obj_by_id(args.image)
-        if not headers or not content:
-            raise RuntimeError(f"Image {args.image} found")
-        release_images.append((headers, content))
+        release_images = [args.image]
     elif args.latest:
         distro, release, variant = args.latest
         release_images = get_latest_image_objs(
@@ -194,74 +255,32 @@ def main(argv=None):
         )
     else:
         # release all images
-        identifiers = []
-        for distro, dv in supports["supported_distros"].items():
-            if "releases" not in dv:
-                continue
-            releases = dv["releases"]
-            for release, rv in releases.items():
-                if "variants" not in rv:
-                    continue
-                for variant in rv["variants"]:
-                    if distro.startswith("ipa_"):
-                        identifiers.append((distro, release, variant, "initramfs"))
-                        identifiers.append((distro, release, variant, "kernel"))
-                    else:
-                        identifiers.append((distro, release, variant, "na"))
-        release_images = get_latest_image_objs(identifiers)
+        release_images = get_latest_image_objs(supports.identifiers)
 
-    glance = chi.glance(session=auth_session)
-    for img in release_images:
-        resp_headers = img[0]
-        source_image_content = img[1]
-        image_production_name = production_name(resp_headers, supports)
-
-        # check if the latest image has been published
-        latest_image = find_latest_published_image(
-            glance, resp_headers, image_production_name
-        )
-        timestamp_header = f"{helpers.SWIFT_META_HEADER_PREFIX}build-timestamp"
-        revision_header = f"{helpers.SWIFT_META_HEADER_PREFIX}build-os-base-image-revision"
-        if (
-            latest_image and
-            latest_image.get("build-timestamp", None) == resp_headers[timestamp_header] and
-            latest_image.get("build-os-base-image-revision", None) == resp_headers[revision_header]
-        ):
-            d, r, v, p = get_identifiers(resp_headers)
-            logging.info(
-                f"The latest image {d}-{r}-{v}-{p} has been released. Nothing to do."
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        futures = {
+            image_id: executor.submit(
+                publish_image, auth_session, supports, image_id
             )
-            continue
-
-        # publish image
-        new_image = copy_image(
-            auth_session, resp_headers, source_image_content
+            for image_id in release_images
+        }
+        for image_id, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logging.exception(f"Failed to publish image {image_id}.")
+                failures[image_id] = e
+
+    if failures:
+        logging.error(
+            f"Failed to publish {len(failures)} of {len(release_images)} images:"
         )
+        for image_id, e in failures.items():
+            logging.error(f"  {image_id}: {e}")
+        return 1
 
-        # rename old image
-        with open(args.site_yaml, 'r') as f:
-            site = yaml.safe_load(f)
-        named_images = list(glance.images.list(filters={
-            'name': image_production_name,
-            'visibility': 'public'}
-        ))
-        if len(named_images) == 1:
-            archive_image(auth_session, named_images[0], image_production_name)
-        elif len(named_images) > 1:
-            raise RuntimeError(
-                'multiple images with the name "{}"'
-                .format(image_production_name))
-        elif len(named_images) < 1:
-            # do nothing
-            logging.info(f"no public production images {image_production_name} found on site")
-
-        # rename new image
-        glance.images.update(
-            new_image["id"],
-            name=image_production_name,
-            visibility="public",
-        )
-        logging.info(f"{image_production_name} has been published successfully!")
+    return 0
 
 
 if __name__ == '__main__':
@@ -2,18 +2,23 @@ import argparse
 import chi
 from chi import lease as chi_lease
 from chi import server as chi_server
+from concurrent.futures import ThreadPoolExecutor
+import json
 import logging
-from novaclient import exceptions as nova_exp
 import operator
+import os
 import random
 import string
 import sys
+import threading
 import time
 
 from utils import helpers
 
 logging.basicConfig(level=logging.INFO)
 NAME = "CC-IPA-TEST-{node_type}-{tag}"
+# node types tested at once, each holding a leased node
+MAX_PARALLEL_NODE_TYPES = 8
 
 
 def _tag_generator(size=6, chars=string.ascii_uppercase + string.digits):
@@ -50,7 +55,72 @@ def _get_latest_ubuntu_image():
     return _get_latest_image(query)
 
 
-def _reserve_resource(node_type, tag):
+class BlazarInventory:
+    """
+    Per-run cache of Blazar hosts and allocations, indexed by lease and by
+    node type. Allocations are only listed again when a lease is looked up
+    that the cached listing predates, and concurrent lookups share that
+    refresh.
+    """
+
+    def __init__(self, blazar=None):
+        self.blazar = blazar or chi.blazar()
+        self._lock = threading.Lock()
+        self._hosts = None
+        self._node_type_hosts = None
+        self._lease_hosts = {}
+        self._allocations_time = None
+
+    def _load_hosts(self):
+        if self._hosts is not None:
+            return
+        self._hosts = {}
+        self._node_type_hosts = {}
+        for host in self.blazar.host.list():
+            self._hosts[host["id"]] = host
+            if "node_type" in host:
+                self._node_type_hosts.setdefault(host["node_type"], []).append(
+                    host["hypervisor_hostname"]
+                )
+
+    def _refresh_allocations(self):
+        self._lease_hosts = {}
+        for alloc in self.blazar.host.list_allocations():
+            for res in alloc["reservations"]:
+                self._lease_hosts.setdefault(res["lease_id"], []).append(
+                    alloc["resource_id"]
+                )
+        self._allocations_time = time.monotonic()
+
+    def node_types(self):
+        with self._lock:
+            self._load_hosts()
+            return sorted(self._node_type_hosts)
+
+    def hosts_for_node_type(self, node_type):
+        with self._lock:
+            self._load_hosts()
+            return list(self._node_type_hosts.get(node_type, []))
+
+    def host_for_lease(self, lease_id):
+        requested_time = time.monotonic()
+        with self._lock:
+            self._load_hosts()
+            if lease_id not in self._lease_hosts and (
+                self._allocations_time is None or
+                self._allocations_time < requested_time
+            ):
+                self._refresh_allocations()
+            resource_ids = self._lease_hosts.get(lease_id)
+            if not resource_ids:
+                return None
+            if resource_ids[0] not in self._hosts:
+                # enrolled since the hosts were listed
+                self._hosts[resource_ids[0]] = self.blazar.host.get(resource_ids[0])
+            return self._hosts[resource_ids[0]]
+
+
+def _reserve_resource(node_type, tag, inventory, timeout=(60 * 20)):
     reservations = []
     chi_lease.add_node_reservation(reservations, count=1, node_type=node_type)
     lease = chi_lease.create_lease(NAME.format(node_type=node_type, tag=tag),
@@ -58,14 +128,16 @@ def _reserve_resource(node_type, tag):
     if not lease:
         raise RuntimeError("Failed to create lease! Try again later!")
 
-    chi_lease.wait_for_active(lease['id'])
+    try:
+        helpers.wait_for_lease_active(lease['id'], timeout=timeout)
+    except Exception:
+        chi_lease.delete_lease(lease["id"])
+        raise
     reservation_id = chi_lease.get_node_reservation(lease["id"])
 
-    for alloc in chi.blazar().host.list_allocations():
-        for res in alloc["reservations"]:
-            if res["lease_id"] == lease["id"]:
-                host = chi.blazar().host.get(alloc["resource_id"])
-                return lease["id"], reservation_id, host["hypervisor_hostname"]
+    host = inventory.host_for_lease(lease["id"])
+    if host:
+        return lease["id"], reservation_id, host["hypervisor_hostname"]
 
     chi_lease.delete_lease(lease["id"])
     raise RuntimeError("Failed to find the eserved host!")
@@ -86,32 +158,106 @@ def _get_ipa_image(node_id):
 
 def _set_ipa_image(node_id, kernel_image_id, ramdisk_image_id):
     ironic = chi.ironic()
+    driver_info = ironic.node.get(node_id).driver_info
     patch = []
-    if kernel_image_id:
-        patch.append({
-             "op": "add",
-             "path": "/driver_info/deploy_kernel",
-             "value": kernel_image_id
-        })
-    else:
-        patch.append({
-             "op": "remove",
-             "path": "/driver_info/deploy_kernel",
-        })
-
-    if ramdisk_image_id:
-        patch.append({
-             "op": "add",
-             "path": "/driver_info/deploy_ramdisk",
-             "value": ramdisk_image_id
-        })
-    else:
-        patch.append({
-             "op": "remove",
-             "path": "/driver_info/deploy_kernel",
-        })
+    for key, image_id in (("deploy_kernel", kernel_image_id),
+                          ("deploy_ramdisk", ramdisk_image_id)):
+        if image_id:
+            patch.append({
+                 "op": "add",
+                 "path": f"/driver_info/{key}",
+                 "value": image_id
+            })
+        elif key in driver_info:
+            # removing a path that is not there is rejected
+            patch.append({
+                 "op": "remove",
+                 "path": f"/driver_info/{key}",
+            })
+
+    if patch:
+        ironic.node.update(node_id, patch)
+
+
+class RollbackFile:
+    """
+    Records the kernel/ramdisk each node used before a rollout. The file
+    is rewritten before every batch is patched so it is always complete
+    enough to revert whatever has been changed so far.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._nodes = {}
+
+    def set_previous(self, node, kernel, ramdisk):
+        with self._lock:
+            self._nodes.setdefault(node, {
+                "deploy_kernel": kernel,
+                "deploy_ramdisk": ramdisk,
+            })
+
+    def record(self, nodes):
+        for node in nodes:
+            if node not in self._nodes:
+                self.set_previous(node, *_get_ipa_image(node))
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._nodes, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+def _set_and_verify_ipa_image(node_id, kernel_image_id, ramdisk_image_id):
+    _set_ipa_image(node_id, kernel_image_id, ramdisk_image_id)
+    kernel, ramdisk = _get_ipa_image(node_id)
+    if (kernel, ramdisk) != (kernel_image_id, ramdisk_image_id):
+        raise RuntimeError(
+            f"{node_id} has kernel {kernel} and ramdisk {ramdisk} after update"
+        )
 
-    ironic.node.update(node_id, patch)
+
+def rollout_ipa_images(targets, rollback_file=None, canary=1,
+                       batch_size=10, concurrency=10):
+    """
+    Patch the driver_info of many nodes. targets maps node to its
+    (kernel, ramdisk) images. A canary stage of `canary` nodes runs first,
+    then batches of batch_size; the rollout stops after the first stage
+    with a failure. Returns the nodes that failed.
+    """
+    nodes = sorted(targets)
+    stages = [nodes[:canary]]
+    stages.extend(
+        nodes[i:i + batch_size] for i in range(canary, len(nodes), batch_size)
+    )
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for stage_num, stage in enumerate(s for s in stages if s):
+            if rollback_file:
+                rollback_file.record(stage)
+            futures = {
+                node: executor.submit(_set_and_verify_ipa_image, node, *targets[node])
+                for node in stage
+            }
+            for node, future in futures.items():
+                try:
+                    future.result()
+                except Exception:
+                    logging.exception(
+                        f"Failed to set kernel and ramdisk image for {node}"
+                    )
+                    failed.append(node)
+            logging.info(
+                f"Rollout stage {stage_num}: {len(stage) - len(failed)} of "
+                f"{len(stage)} nodes updated"
+            )
+            if failed:
+                logging.error("Stopping rollout after failed stage.")
+                break
+
+    return failed
 
 
 def _create_instance(reservation_id, node_type, tag):
@@ -126,28 +272,92 @@ def _create_instance(reservation_id, node_type, tag):
     return server.id
 
 
-def _wait_for_delete(server_id, timeout=(60 * 10), sleep_time=5):
-    start_time = time.perf_counter()
+def _remaining(deadline):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("Ran out of time testing IPA images")
+    return remaining
 
-    while True:
-        try:
-            chi_server.show_server(server_id)
-        except nova_exp.NotFound:
-            return
-        time.sleep(sleep_time)
-        if time.perf_counter() - start_time >= timeout:
-            raise TimeoutError((
-                f'Waited too long for deleting server {server_id}'))
 
+def test_node_type(node_type, inventory, kernel_image, ramdisk_image, deadline,
+                   push=None):
+    """
+    Reserve a node of node_type, boot an instance on it with the given IPA
+    images and restore its driver_info afterwards. If push is given (the
+    keyword arguments of rollout_ipa_images), roll the images out to every
+    node of the type instead. Returns a result row for the final matrix.
+    """
+    result = {"node_type": node_type, "host": None, "passed": False, "detail": ""}
+    test_tag = _tag_generator()
+
+    lease_id, reservation_id, host = _reserve_resource(
+        node_type, test_tag, inventory, timeout=_remaining(deadline)
+    )
+    result["host"] = host
+    logging.info(f"Reserved node {host} for {node_type}")
+    server_id = None
+    orig_images = None
+
+    try:
+        orig_images = _get_ipa_image(host)
+        orig_kernel, orig_ramdisk = orig_images
+        _set_ipa_image(host, kernel_image, ramdisk_image)
+        server_id = _create_instance(reservation_id, node_type, test_tag)
+        helpers.wait_for_server_active(server_id, timeout=_remaining(deadline))
+        logging.info(
+            (f"Images {kernel_image} and {ramdisk_image} "
+             f"passed the test on {node_type}!")
+        )
+        result["passed"] = True
+        chi_server.delete_server(server_id)
+        helpers.wait_for_server_deleted(server_id, timeout=_remaining(deadline))
+        server_id = None
+        if push:
+            # set all nodes using new kernel and ramdisk images
+            nodes = inventory.hosts_for_node_type(node_type)
+            if push.get("rollback_file"):
+                # the reserved node already runs the images under test
+                push["rollback_file"].set_previous(host, orig_kernel, orig_ramdisk)
+            failed = rollout_ipa_images(
+                {node: (kernel_image, ramdisk_image) for node in nodes},
+                **push,
+            )
+            if failed:
+                # the images passed, but nodes are left half rolled out
+                result["passed"] = False
+                result["detail"] = f"rollout failed on {', '.join(failed)}"
+        else:
+            # reset the reserved node
+            _set_ipa_image(host, orig_kernel, orig_ramdisk)
+    except Exception as e:
+        logging.exception(
+            (f"Images {kernel_image} and {ramdisk_image} "
+             f"failed the test on {node_type}!")
+        )
+        result["detail"] = str(e)
+        try:
+            if server_id:
+                chi_server.delete_server(server_id)
+                helpers.wait_for_server_deleted(server_id)
+            if orig_images:
+                _set_ipa_image(host, *orig_images)
+        except Exception:
+            logging.exception(
+                f"Failed to delete server or reset driver info for {host}"
+            )
+    finally:
+        chi_lease.delete_lease(lease_id)
 
-def _get_all_nodes(node_type):
-    result = []
-    for host in chi.blazar().host.list():
-        if "node_type" in host and host["node_type"] == node_type:
-            result.append(host["hypervisor_hostname"])
     return result
 
 
+def log_results(results):
+    logging.info("IPA test results:")
+    for r in sorted(results, key=lambda r: r["node_type"]):
+        status = "PASS" if r["passed"] else "FAIL"
+        logging.info(f"  {r['node_type']:<30} {str(r['host']):<20} {status} {r['detail']}")
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
@@ -159,8 +369,12 @@ def main(argv=None):
 
     parser.add_argument("--site-yaml", type=str, required=True,
                         help="A yaml file with site credentials.")
-    parser.add_argument('--node-type', type=str, required=True,
-                        help='Test IPA images on a specified node type')
+    node_types = parser.add_mutually_exclusive_group()
+    node_types.add_argument('--node-type', type=str,
+                            help='Test IPA images on a specified node type')
+    node_types.add_argument('--node-types', type=str,
+                            help=('Comma-separated node types to test at once, '
+                                  'or "all" for every node type in Blazar'))
     parser.add_argument('--initramfs-image', type=str,
                         help=('Specific initramfs image id to test;'
                               'default to latest'))
@@ -170,12 +384,52 @@ def main(argv=None):
     parser.add_argument('--push', action='store_true',
                         help=('update all nodes for the chosen node type '
                               'to use the tested ipa image'))
+    parser.add_argument('--timeout-minutes', type=int, default=120,
+                        help='Deadline shared by all node types; default 120')
+    parser.add_argument('--canary', type=int, default=1,
+                        help='With --push, number of nodes updated before the rest; default 1')
+    parser.add_argument('--batch-size', type=int, default=10,
+                        help='With --push, number of nodes per rollout stage; default 10')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='With --push, number of nodes updated at once; default 10')
+    parser.add_argument('--rollback-file', type=str,
+                        help=('With --push, where to record the previous images of '
+                              'every node; default ipa-rollback-<timestamp>.json'))
+    parser.add_argument('--rollback', type=str, metavar='ROLLBACK_FILE',
+                        help='Restore every node recorded in a rollback file and exit')
 
     args = parser.parse_args(argv[1:])
+    if not args.rollback and not (args.node_type or args.node_types):
+        parser.error("one of --node-type, --node-types or --rollback is required")
 
     chi.reset()
     helpers.set_chi_session_from_yaml(args.site_yaml)
 
+    if args.rollback:
+        with open(args.rollback, "r") as f:
+            previous = json.load(f)
+        failed = rollout_ipa_images(
+            {
+                node: (images["deploy_kernel"], images["deploy_ramdisk"])
+                for node, images in previous.items()
+            },
+            canary=0,
+            batch_size=max(1, len(previous)),
+            concurrency=args.concurrency,
+        )
+        return 1 if failed else 0
+
+    push = None
+    if args.push:
+        rollback_path = args.rollback_file or f"ipa-rollback-{int(time.time())}.json"
+        logging.info(f"Recording previous IPA images in {rollback_path}")
+        push = {
+            "rollback_file": RollbackFile(rollback_path),
+            "canary": args.canary,
+            "batch_size": args.batch_size,
+            "concurrency": args.concurrency,
+        }
+
     target_kernel_image = args.kernel_image
     if not target_kernel_image:
         target_kernel_image = _get_latest_ipa_image("kernel")
@@ -183,51 +437,40 @@ def main(argv=None):
     if not target_ramdisk_image:
         target_ramdisk_image = _get_latest_ipa_image("initramfs")
 
-    test_tag = _tag_generator()
-
-    lease_id, reservation_id, host = _reserve_resource(
-        args.node_type, test_tag
-    )
-    logging.info(f"Reserved node {host}")
-    orig_kernel, orig_ramdisk = _get_ipa_image(host)
-    _set_ipa_image(host, target_kernel_image, target_ramdisk_image)
-
-    try:
-        server_id = _create_instance(reservation_id, args.node_type, test_tag)
-        chi_server.wait_for_active(server_id)
-        logging.info(
-            (f"Images {target_kernel_image} and {target_ramdisk_image} "
-             "passed the test!")
-        )
-        chi_server.delete_server(server_id)
-        _wait_for_delete(server_id)
-        if args.push:
-            # set all nodes using new kernel and ramdisk images
-            for node in _get_all_nodes(args.node_type):
-                try:
-                    _set_ipa_image(
-                        node, target_kernel_image, target_ramdisk_image
-                    )
-                except Exception:
-                    logging.exception(
-                        f"Failed to set kernel and ramdisk image for {node}"
-                    )
-        else:
-            # reset the reserved node
-            _set_ipa_image(host, orig_kernel, orig_ramdisk)
-    except Exception:
-        logging.exception(
-            (f"Images {target_kernel_image} and {target_ramdisk_image} "
-             "failed the test!")
-        )
-        try:
-            chi_server.delete_server(server_id)
-            _wait_for_delete(server_id)
-            _set_ipa_image(host, orig_kernel, orig_ramdisk)
-        except Exception:
-            logging.exception("Failed to delete server or reset driver info")
-
-    chi_lease.delete_lease(lease_id)
+    inventory = BlazarInventory()
+    if args.node_type:
+        node_types = [args.node_type]
+    elif args.node_types == "all":
+        node_types = inventory.node_types()
+    else:
+        node_types = [t.strip() for t in (args.node_types or "").split(",") if t.strip()]
+    if not node_types:
+        parser.error("no node types to test; give --node-type or --node-types")
+
+    deadline = time.monotonic() + args.timeout_minutes * 60
+    results = []
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(len(node_types), MAX_PARALLEL_NODE_TYPES))
+    ) as executor:
+        futures = {
+            node_type: executor.submit(
+                test_node_type, node_type, inventory, target_kernel_image,
+                target_ramdisk_image, deadline, push=push,
+            )
+            for node_type in node_types
+        }
+        for node_type, future in futures.items():
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.exception(f"Failed to test {node_type}")
+                results.append({
+                    "node_type": node_type, "host": None,
+                    "passed": False, "detail": str(e),
+                })
+
+    log_results(results)
+    return 0 if all(r["passed"] for r in results) else 1
 
 
 if __name__ == '__main__':
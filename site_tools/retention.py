@@ -0,0 +1,196 @@
+'''
+Retention policies for the image cleaner.
+
+The policies are read from the site yaml:
+
+    hide_image_age_in_month: 3       # hide images older than this
+    delete_image_age_in_month: 6     # delete images older than this
+    keep_last_per_identifier: 5      # delete all but the newest N per identifier
+    storage_budget_in_gb: 2000       # whole site, or per Glance store:
+                                     #   {"rbd": 2000, "swift": 5000}
+
+All of them are optional. The storage budget only covers the images the
+cleaner manages, the public Chameleon-built ones: hidden or private
+images, user snapshots and anything else in the same store are not
+counted, so set it below the store's real capacity by what those use.
+
+A full plan of hide/delete actions is built up
+front so it can be reviewed (or just printed on dry-run) before acting.
+'''
+from datetime import date, datetime
+from dateutil.relativedelta import relativedelta
+import logging
+import operator
+
+SITE_BUDGET = "site"
+
+
+def created_date(img):
+    return datetime.strptime(img["created_at"], "%Y-%m-%dT%H:%M:%SZ").date()
+
+
+def validate_policy(policy):
+    hide_image_age_in_month = policy.get("hide_image_age_in_month")
+    delete_image_age_in_month = policy.get("delete_image_age_in_month")
+    if (
+        hide_image_age_in_month is not None and
+        delete_image_age_in_month is not None and
+        hide_image_age_in_month >= delete_image_age_in_month
+    ):
+        raise ValueError(
+            "Parameter hide_image_age_in_month must be smaller than delete_image_age_in_month"
+        )
+    keep_last = policy.get("keep_last_per_identifier")
+    if keep_last is not None and keep_last < 1:
+        raise ValueError("Parameter keep_last_per_identifier must be at least 1")
+
+
+def storage_budgets(policy):
+    """
+    Return the storage budgets in bytes, keyed by Glance store id or by
+    SITE_BUDGET for a budget covering every store. Only the public
+    Chameleon-built images are counted against them.
+    """
+    budget = policy.get("storage_budget_in_gb")
+    if budget is None:
+        return {}
+    if not isinstance(budget, dict):
+        budget = {SITE_BUDGET: budget}
+    return {backend: int(gb * 2**30) for backend, gb in budget.items()}
+
+
+def image_backends(img, budgets):
+    backends = [
+        store for store in (img.get("stores") or "").split(",")
+        if store in budgets
+    ]
+    if SITE_BUDGET in budgets:
+        backends.append(SITE_BUDGET)
+    return backends
+
+
+def build_plan(groups, candidates, policy, skip_images=(), today=None):
+    """
+    Work out every hide/delete action before acting.
+
+    groups: identifier -> all public images of that identifier; these are
+        counted against the storage budgets.
+    candidates: identifier -> images allowed to be hidden or deleted, i.e.
+        with the current production and in-use images already excluded.
+
+    Returns a list of (action, image, reason) tuples.
+    """
+    if today is None:
+        today = date.today()
+    skip_images = set(skip_images)
+    plan = {}
+
+    def _add(action, img, reason):
+        if img["id"] in skip_images:
+            return
+        # deleting always wins over hiding
+        if img["id"] in plan and plan[img["id"]][0] == "delete":
+            return
+        plan[img["id"]] = (action, img, reason)
+
+    # time-based policy
+    hide_image_age_in_month = policy.get("hide_image_age_in_month")
+    delete_image_age_in_month = policy.get("delete_image_age_in_month")
+    for images in candidates.values():
+        for img in images:
+            create_date = created_date(img)
+            if (
+                delete_image_age_in_month is not None and
+                create_date <= today + relativedelta(months=-delete_image_age_in_month)
+            ):
+                _add("delete", img, f"older than {delete_image_age_in_month} months")
+            elif (
+                hide_image_age_in_month is not None and
+                create_date <= today + relativedelta(months=-hide_image_age_in_month)
+            ):
+                _add("hide", img, f"older than {hide_image_age_in_month} months")
+
+    # keep last N per identifier
+    keep_last = policy.get("keep_last_per_identifier")
+    if keep_last is not None:
+        for identifier, images in candidates.items():
+            newest = sorted(
+                groups[identifier], key=operator.itemgetter("created_at"), reverse=True
+            )[:keep_last]
+            keep_ids = {img["id"] for img in newest}
+            for img in images:
+                if img["id"] not in keep_ids:
+                    _add("delete", img, f"not among the newest {keep_last}")
+
+    # storage budgets, evicting oldest first across all groups
+    budgets = storage_budgets(policy)
+    if budgets:
+        usage = dict.fromkeys(budgets, 0)
+        for images in groups.values():
+            for img in images:
+                if img["id"] in plan and plan[img["id"]][0] == "delete":
+                    continue
+                for backend in image_backends(img, budgets):
+                    usage[backend] += img.get("size") or 0
+
+        evictable = sorted(
+            (
+                img for images in candidates.values() for img in images
+                if img["id"] not in skip_images and not (
+                    img["id"] in plan and plan[img["id"]][0] == "delete"
+                )
+            ),
+            key=operator.itemgetter("created_at"),
+        )
+        for img in evictable:
+            if all(usage[b] <= budgets[b] for b in budgets):
+                break
+            backends = image_backends(img, budgets)
+            if not any(usage[b] > budgets[b] for b in backends):
+                continue
+            _add("delete", img, "over storage budget")
+            for backend in backends:
+                usage[backend] -= img.get("size") or 0
+
+        for backend, used in usage.items():
+            if used > budgets[backend]:
+                logging.warning(
+                    f"Storage budget for {backend} is still exceeded by public "
+                    "Chameleon images "
+                    f"({used / 2**30:.2f} > {budgets[backend] / 2**30:.2f} GiB); "
+                    "the remaining images are protected."
+                )
+
+    return list(plan.values())
+
+
+def crossed_age_cutoff(img, policy, since, today=None):
+    """
+    Whether img passed the hide or delete age cutoff between the dates
+    since and today, i.e. whether time alone changed its retention.
+    """
+    if today is None:
+        today = date.today()
+    create_date = created_date(img)
+    for key in ("hide_image_age_in_month", "delete_image_age_in_month"):
+        months = policy.get(key)
+        if months is None:
+            continue
+        if (
+            since + relativedelta(months=-months)
+            < create_date <=
+            today + relativedelta(months=-months)
+        ):
+            return True
+    return False
+
+
+def log_plan(plan):
+    for action, img, reason in sorted(plan, key=lambda p: p[1]["created_at"]):
+        logging.info(f"Plan: {action} {img['name']} (id: {img['id']}): {reason}")
+    deleted_bytes = sum(img.get("size") or 0 for action, img, _ in plan if action == "delete")
+    logging.info(
+        f"Plan: {sum(1 for p in plan if p[0] == 'delete')} deletions "
+        f"({deleted_bytes / 2**30:.2f} GiB), "
+        f"{sum(1 for p in plan if p[0] == 'hide')} hides"
+    )
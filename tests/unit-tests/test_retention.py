@@ -0,0 +1,144 @@
+from datetime import date
+
+import pytest
+
+from site_tools import retention
+
+TODAY = date(2024, 7, 1)
+GROUP = ("ubuntu", "jammy", "base", "na")
+
+
+def image(image_id, created_at, size=2**30, stores="rbd", identifier=GROUP):
+    distro, release, variant, ipa = identifier
+    return {
+        "id": image_id,
+        "name": f"image-{image_id}",
+        "created_at": f"{created_at}T00:00:00Z",
+        "size": size,
+        "stores": stores,
+        "build-distro": distro,
+        "build-release": release,
+        "build-variant": variant,
+        "build-ipa": ipa,
+    }
+
+
+def actions(plan):
+    return {img["id"]: action for action, img, _ in plan}
+
+
+def test_validate_policy_rejects_hide_after_delete():
+    with pytest.raises(ValueError):
+        retention.validate_policy({
+            "hide_image_age_in_month": 6,
+            "delete_image_age_in_month": 3,
+        })
+
+
+def test_validate_policy_rejects_keep_last_zero():
+    with pytest.raises(ValueError):
+        retention.validate_policy({"keep_last_per_identifier": 0})
+
+
+def test_age_hides_then_deletes():
+    images = [
+        image("new", "2024-06-01"),
+        image("hide", "2024-02-01"),
+        image("delete", "2023-11-01"),
+    ]
+    plan = retention.build_plan(
+        {GROUP: images}, {GROUP: images},
+        {"hide_image_age_in_month": 3, "delete_image_age_in_month": 6},
+        today=TODAY,
+    )
+    assert actions(plan) == {"hide": "hide", "delete": "delete"}
+
+
+def test_keep_last_counts_protected_images():
+    # the newest image is production and so not a candidate, but it still
+    # counts as one of the images kept
+    images = [image(str(i), f"2024-0{i}-01") for i in range(1, 6)]
+    plan = retention.build_plan(
+        {GROUP: images}, {GROUP: images[:-1]},
+        {"keep_last_per_identifier": 2},
+        today=TODAY,
+    )
+    assert actions(plan) == {"1": "delete", "2": "delete", "3": "delete"}
+
+
+def test_keep_last_delete_wins_over_hide():
+    images = [image("old", "2024-01-01"), image("new", "2024-06-01")]
+    plan = retention.build_plan(
+        {GROUP: images}, {GROUP: images[:1]},
+        {"hide_image_age_in_month": 3, "keep_last_per_identifier": 1},
+        today=TODAY,
+    )
+    assert actions(plan) == {"old": "delete"}
+
+
+def test_budget_evicts_oldest_first_across_groups():
+    other = ("centos", "8-stream", "base", "na")
+    group = [image("a1", "2024-01-01"), image("a3", "2024-03-01")]
+    other_group = [
+        image("b2", "2024-02-01", identifier=other),
+        image("b4", "2024-04-01", identifier=other),
+    ]
+    plan = retention.build_plan(
+        {GROUP: group, other: other_group},
+        {GROUP: group, other: other_group},
+        {"storage_budget_in_gb": 2},
+        today=TODAY,
+    )
+    assert actions(plan) == {"a1": "delete", "b2": "delete"}
+
+
+def test_budget_per_store_only_evicts_from_that_store():
+    images = [
+        image("swift-old", "2024-01-01", stores="swift"),
+        image("rbd-old", "2024-02-01", stores="rbd"),
+        image("rbd-new", "2024-03-01", stores="rbd"),
+    ]
+    plan = retention.build_plan(
+        {GROUP: images}, {GROUP: images},
+        {"storage_budget_in_gb": {"rbd": 1}},
+        today=TODAY,
+    )
+    assert actions(plan) == {"rbd-old": "delete"}
+
+
+def test_budget_skips_images_already_deleted():
+    images = [image("old", "2023-01-01"), image("new", "2024-06-01")]
+    plan = retention.build_plan(
+        {GROUP: images}, {GROUP: images},
+        {"delete_image_age_in_month": 6, "storage_budget_in_gb": 1},
+        today=TODAY,
+    )
+    assert actions(plan) == {"old": "delete"}
+
+
+def test_budget_never_touches_protected_images():
+    images = [image("prod", "2024-01-01"), image("new", "2024-06-01")]
+    plan = retention.build_plan(
+        {GROUP: images}, {GROUP: images[1:]},
+        {"storage_budget_in_gb": 1},
+        today=TODAY,
+    )
+    assert actions(plan) == {"new": "delete"}
+
+
+def test_skip_images_are_left_alone():
+    images = [image("old", "2023-01-01")]
+    plan = retention.build_plan(
+        {GROUP: images}, {GROUP: images},
+        {"delete_image_age_in_month": 6},
+        skip_images=["old"],
+        today=TODAY,
+    )
+    assert plan == []
+
+
+def test_crossed_age_cutoff():
+    img = image("a", "2024-03-15")
+    policy = {"hide_image_age_in_month": 3}
+    assert retention.crossed_age_cutoff(img, policy, date(2024, 6, 10), today=TODAY)
+    assert not retention.crossed_age_cutoff(img, policy, date(2024, 6, 20), today=TODAY)
@@ -0,0 +1,118 @@
+'''
+The supports.yaml catalog of supported images, shared by every tool.
+
+load() parses and validates a supports.yaml once per path and returns a
+Catalog. It expands the full build matrix, with IPA distros split into
+their kernel and initramfs images, and indexes it so production names,
+identifiers and builder defaults are plain dict lookups in both
+directions.
+
+An identifier is (distro, release, variant, ipa), with ipa "na" for
+everything but IPA images, as in the build-* image properties.
+'''
+import functools
+
+import yaml
+from pyaml_env import parse_config
+
+# relative to scripts/, where the build tools run
+DEFAULT_PATH = "../supports.yaml"
+# where the site tools' container mounts it
+SITE_PATH = "/etc/chameleon_image_tools/supports.yaml"
+
+IPA_IMAGES = ("kernel", "initramfs")
+
+
+def is_ipa(distro):
+    return distro.startswith("ipa_")
+
+
+class Catalog:
+    def __init__(self, supports, raw=None):
+        self.supports = supports
+        self.distros = supports["supported_distros"]
+        # as written, without environment variables substituted
+        self._raw_distros = (raw or supports)["supported_distros"]
+        self.variants = supports["supported_variants"]
+        self._validate()
+
+        # (distro, release, variant) of every image built
+        self.targets = [
+            (distro, release, variant)
+            for distro, distro_spec in self.distros.items()
+            for release, release_spec in distro_spec.get("releases", {}).items()
+            for variant in release_spec.get("variants", [])
+        ]
+        # every identifier published
+        self.identifiers = [
+            (distro, release, variant, ipa)
+            for distro, release, variant in self.targets
+            for ipa in (IPA_IMAGES if is_ipa(distro) else ("na",))
+        ]
+        self._identifiers_by_name = {
+            self.production_name(*identifier): identifier
+            for identifier in self.identifiers
+        }
+
+    def _validate(self):
+        for distro, distro_spec in self.distros.items():
+            for release, release_spec in distro_spec.get("releases", {}).items():
+                if "prod_name" not in release_spec:
+                    raise ValueError(f"{distro} {release} has no prod_name")
+                for variant in release_spec.get("variants", []):
+                    if variant not in self.variants:
+                        raise ValueError(
+                            f"{distro} {release} uses unknown variant {variant}"
+                        )
+        for variant, variant_spec in self.variants.items():
+            if "builder_default_node_type" not in variant_spec:
+                raise ValueError(f"variant {variant} has no builder_default_node_type")
+
+    def release(self, distro, release):
+        return self.distros[distro]["releases"][release]
+
+    def production_name(self, distro, release, variant, ipa="na"):
+        prod_name = self.release(distro, release)["prod_name"]
+        suffix = self.variants[variant].get("prod_name_suffix")
+        if suffix:
+            prod_name = f"{prod_name}-{suffix}"
+        if ipa != "na":
+            prod_name = f"{prod_name}.{ipa}"
+        return prod_name
+
+    def identifier(self, production_name):
+        """
+        The identifier of a production name, or None if no supported
+        image has that name.
+        """
+        return self._identifiers_by_name.get(production_name)
+
+    def node_type(self, variant):
+        return self.variants[variant]["builder_default_node_type"]
+
+    def builder_image(self, distro, release):
+        release_spec = self.release(distro, release)
+        return release_spec.get("default_builder_image", release_spec["prod_name"])
+
+    def disk_format(self, distro):
+        return self.distros[distro].get("disk_format", "qcow2")
+
+    def extra_params(self, distro):
+        return self.distros[distro].get("extra_params", "")
+
+    def extra_params_template(self, distro):
+        """
+        extra_params before ${VAR}s are substituted, which is the same
+        whatever environment the catalog is loaded in.
+        """
+        return self._raw_distros[distro].get("extra_params", "")
+
+    def variant_metadata(self, variant):
+        return self.variants[variant].get("variant_metadata", {})
+
+
+@functools.lru_cache(maxsize=None)
+def load(path=DEFAULT_PATH):
+    with open(path) as f:
+        raw = yaml.safe_load(f)
+    return Catalog(parse_config(path), raw)
@@ -1,7 +1,14 @@
+import atexit
+import codecs
+import hashlib
+import itertools
+import json
 import os
 import shlex
 import smtplib
+import socket
 import subprocess
+import threading
 import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -9,22 +16,35 @@ from email.mime.text import MIMEText
 import chi
 import paramiko.ssh_exception
 import yaml
+from chi import lease as chi_lease
+from chi import server as chi_server
 from fabric import connection as fconn
 from jinja2 import Environment
 from keystoneauth1 import loading, session
 from keystoneauth1.identity import v3
+from novaclient import exceptions as nova_exp
 from swiftclient.client import Connection as swift_conn
 
-from utils import whatsnew
+from utils import waiter, whatsnew
 
 CENTRALIZED_CONTAINER_NAME = "chameleon-images"
 CENRTALIZED_CONTAINER_ACCOUNT = "AUTH_570aad8999f7499db99eae22fe9b29bb"
 CENTRALIZED_CONTAINER_URL = f"https://chi.tacc.chameleoncloud.org:7480/swift/v1/{CENRTALIZED_CONTAINER_ACCOUNT}/{CENTRALIZED_CONTAINER_NAME}"
+# Glance location of an object in the centralized container
+CENTRALIZED_LOCATION_PREFIX = f"swift+{CENTRALIZED_CONTAINER_URL}"
+# private container builds are uploaded to until imagedist publishes them;
+# sites deploy whatever is in the centralized container
+CENTRALIZED_STAGING_CONTAINER_NAME = "chameleon-images-staging"
+CENTRALIZED_STAGING_LOCATION_PREFIX = f"swift+https://chi.tacc.chameleoncloud.org:7480/swift/v1/{CENRTALIZED_CONTAINER_ACCOUNT}/{CENTRALIZED_STAGING_CONTAINER_NAME}"
 CHAMELEON_CORE_SITES = ["uc", "tacc"]
 CENTRALIZED_STORE = "swift"
 CENTRALIZED_STORE_SITE = "tacc"
 CENTRALIZED_STORE_REGION_NAME = "CHI@TACC"
 SWIFT_META_HEADER_PREFIX = "x-object-meta-"
+BUILD_KEY_PROPERTY = "build-key"
+
+LEASE_FAILED_STATES = {"ERROR", "TERMINATING", "TERMINATED", "DELETING"}
+SERVER_FAILED_STATES = {"ERROR", "DELETED"}
 
 
 EMAIL_TEMPLATE = """
@@ -97,6 +117,48 @@ a ticket on our <a href="https://chameleoncloud.org/user/help/">help desk</a>.
 <br><br>
 """
 
+DIGEST_EMAIL_TEMPLATE = """
+<div style="width: 90%; margin: auto; font-family: 'Open Sans', 'Helvetica', sans-serif; font-size: 11pt;">
+<p>
+We have released new versions of {{ images|length }} images!
+</p>
+
+{% for image in images %}
+<p>
+{{ image["name"] }} (id: {{ image["id"] }})
+<ul>
+    <li>Distro: {{ image["build-distro"] }}</li>
+    <li>Release: {{ image["build-release"] }}</li>
+    <li>Variant: {{ image["build-variant"] }}</li>
+    <li>Base image revision: {{ image["build-os-base-image-revision"] }}</li>
+    <li>Build timestamp: {{ image["build-timestamp"] }}</li>
+</ul>
+</p>
+{% endfor %}
+
+<p>
+If you have the automatic image deployer set via CHI-in-a-Box,
+it will auto-deploy these images.
+Otherwise, to download and deploy one of them to your site, run
+</p>
+
+<p><small><code>
+docker run --rm --net=host -v "/etc/chameleon_image_tools/site.yaml:/etc/chameleon_image_tools/site.yaml"
+docker.chameleoncloud.org/chameleon_image_tools:latest deploy
+--site-yaml /etc/chameleon_image_tools/site.yaml
+--image &lt;id&gt;
+</code></small></p>
+
+<p><i>This is an automatic email, please <b>DO NOT</b> reply!
+If you have any question or issue with the images, please submit
+a ticket on our <a href="https://chameleoncloud.org/user/help/">help desk</a>.
+</i></p>
+
+<p>Thanks,</p>
+<p>Chameleon Team</p>
+</div>
+"""
+
 
 def archival_name(prod_image_name, image):
     return "{}-{}-{}".format(
@@ -110,6 +172,46 @@ def get_latest_revision(distro, release):
     return class_method(release)["revision"]
 
 
+def get_latest_revisions(releases, concurrency=8):
+    """
+    get_latest_revision for many (distro, release) pairs at once.
+    """
+    newest = whatsnew.Newest(session=whatsnew.make_session(concurrency))
+    results = newest.revisions(releases, concurrency=concurrency)
+    return {release: result["revision"] for release, result in results.items()}
+
+
+def build_key(supports, distro, release, variant, base_image_revision, commit,
+              builder_image):
+    """
+    Hash of every input that decides what a build produces. An image
+    carrying the same key in its build-key property would be rebuilt
+    identically.
+    """
+    inputs = {
+        "distro": distro,
+        "release": release,
+        "variant": variant,
+        "base-image-revision": base_image_revision,
+        "repo-commit": commit,
+        "variant-metadata": supports.variant_metadata(variant),
+        # unset OS_ variables would make the substituted params differ
+        # between check_update_and_build and the build itself
+        "extra-params": supports.extra_params_template(distro),
+        "builder-image": builder_image,
+    }
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def find_images_by_build_key(glance, key):
+    return list(glance.images.list(filters={
+        BUILD_KEY_PROPERTY: key,
+        "status": "active",
+    }))
+
+
 def get_auth_session_from_rc(rc):
     """
     Generates a Keystone Session from an OS parameter dictionary.  Dict
@@ -172,23 +274,242 @@ def run(command, **kwargs):
     return subprocess.run(command, **runargs)
 
 
+class SSHConnections:
+    """
+    One authenticated Fabric connection per host, kept open and shared so a
+    build does not pay an SSH handshake for every remote command. Each
+    command opens its own channel on the host's transport, so concurrent
+    commands to the same host are fine. Dropped connections are reopened
+    on next use.
+    """
+
+    KEEPALIVE_SECONDS = 30
+
+    def __init__(self, user="cc"):
+        self.user = user
+        self._keys = {}
+        self._connections = {}
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    def key(self):
+        path = os.path.expanduser(os.environ.get("SSH_KEY_FILE", "~/.ssh/id_rsa"))
+        with self._lock:
+            if path not in self._keys:
+                # Key is resolved manually as RSA because of a bug in paramiko which
+                # attempts to resolve it as a DSA key
+                self._keys[path] = paramiko.RSAKey.from_private_key_file(path)
+            return self._keys[path]
+
+    def _host_lock(self, ip):
+        with self._lock:
+            return self._host_locks.setdefault(ip, threading.Lock())
+
+    def get(self, ip):
+        with self._host_lock(ip):
+            c = self._connections.get(ip)
+            if c is not None and c.is_connected:
+                return c
+            if c is not None:
+                c.close()
+            c = fconn.Connection(ip, user=self.user, connect_kwargs={"pkey": self.key()})
+            try:
+                c.open()
+            except Exception:
+                c.close()
+                raise
+            c.transport.set_keepalive(self.KEEPALIVE_SECONDS)
+            self._connections[ip] = c
+            return c
+
+    def close(self, ip):
+        with self._host_lock(ip):
+            c = self._connections.pop(ip, None)
+            if c is not None:
+                c.close()
+
+    def close_all(self):
+        with self._lock:
+            ips = list(self._connections)
+        for ip in ips:
+            self.close(ip)
+
+
+ssh_connections = SSHConnections()
+atexit.register(ssh_connections.close_all)
+
+# failures to connect to a node that may still be booting
+SSH_RETRYABLE_ERRORS = (
+    paramiko.ssh_exception.NoValidConnectionsError,
+    socket.timeout,
+    ConnectionError,
+    EOFError,
+)
+
+
+def _connect_with_retries(ip, retries, delay_seconds):
+    # a missing or unreadable key never gets better; fail on it at once
+    ssh_connections.key()
+    deadline = time.monotonic() + retries * delay_seconds
+    delays = waiter.backoff_delays(maximum=max(delay_seconds, 30))
+    while True:
+        try:
+            return ssh_connections.get(ip)
+        except SSH_RETRYABLE_ERRORS:
+            delay = next(delays)
+            if time.monotonic() + delay >= deadline:
+                raise
+            time.sleep(delay)
+
+
+def _with_ssh_retries(ip, retries, delay_seconds, func):
+    """
+    Call func with a connection to ip, retrying only the connecting.
+    func itself runs once, since commands need not be idempotent.
+    """
+    c = _connect_with_retries(ip, retries, delay_seconds)
+    try:
+        return func(c)
+    except (paramiko.ssh_exception.SSHException, EOFError, OSError):
+        # the connection may be dead; reopen it on next use
+        ssh_connections.close(ip)
+        raise
+
+
 def remote_run(ip, retries=20, delay_seconds=5, *args, **kwargs):
-    tries = 0
-    error = None
-    # Key is resolved manually as RSA because of a bug in paramiko which attempts to resolve it
-    # as a DSA key
-    key = paramiko.RSAKey.from_private_key_file(
-        os.path.expanduser(os.environ.get("SSH_KEY_FILE", "~/.ssh/id_rsa"))
+    """
+    Run a command on ip over its pooled connection, retrying failures to
+    connect with backoff for up to retries * delay_seconds in total.
+    """
+    return _with_ssh_retries(
+        ip, retries, delay_seconds, lambda c: c.run(warn=True, *args, **kwargs)
     )
-    while tries < retries:
+
+
+def remote_stream(ip, command, out_stream, pty=True, retries=20, delay_seconds=5):
+    """
+    Run a command on ip, writing its output to out_stream as it arrives
+    instead of collecting it, and return its exit status. Only connecting
+    is retried; the command itself runs once.
+    """
+    c = _connect_with_retries(ip, retries, delay_seconds)
+    channel = c.transport.open_session()
+    try:
+        if pty:
+            channel.get_pty(width=200)
+        else:
+            channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        while True:
+            data = channel.recv(32768)
+            if not data:
+                break
+            out_stream.write(decoder.decode(data))
+        out_stream.write(decoder.decode(b"", final=True))
+        return channel.recv_exit_status()
+    finally:
+        channel.close()
+
+
+def remote_put(ip, local, remote=None, retries=20, delay_seconds=5):
+    """
+    Copy a local file to ip over SFTP on its pooled connection.
+    """
+    return _with_ssh_retries(
+        ip, retries, delay_seconds, lambda c: c.put(local, remote=remote)
+    )
+
+
+def poll_lease(lease_id):
+    return lambda: chi_lease.get_lease(lease_id)["status"]
+
+
+def poll_server(server_id):
+    def _poll():
         try:
-            with fconn.Connection(ip, user="cc", connect_kwargs={"pkey": key}) as c:
-                return c.run(warn=True, *args, **kwargs)
-        except paramiko.ssh_exception.SSHException as e:
-            error = e
-            tries += 1
-            time.sleep(delay_seconds)
-    raise error
+            return chi_server.show_server(server_id).status
+        except nova_exp.NotFound:
+            return "DELETED"
+    return _poll
+
+
+def wait_for_lease_active(lease_id, timeout=(60 * 20)):
+    waiter.wait_for(
+        f"lease {lease_id}", poll_lease(lease_id),
+        {"ACTIVE"}, LEASE_FAILED_STATES, timeout=timeout,
+    )
+
+
+def wait_for_server_active(server_id, timeout=(60 * 20)):
+    waiter.wait_for(
+        f"server {server_id}", poll_server(server_id),
+        {"ACTIVE"}, SERVER_FAILED_STATES, timeout=timeout,
+    )
+
+
+def wait_for_server_deleted(server_id, timeout=(60 * 10)):
+    # servers deleted from ERROR stay in ERROR until they are gone
+    waiter.wait_for(
+        f"server {server_id}", poll_server(server_id),
+        {"DELETED"}, timeout=timeout,
+    )
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter spacing calls so at most ``rate`` start per second.
+    A falsy rate disables limiting.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start_time = max(now, self._next_time)
+            self._next_time = start_time + self.interval
+        time.sleep(max(0, start_time - now))
+
+
+def get_http_status(exc):
+    """
+    Best-effort HTTP status of an OpenStack client exception
+    (keystoneauth, glanceclient, novaclient, swiftclient).
+    """
+    for attr in ("http_status", "code", "status_code"):
+        status = getattr(exc, attr, None)
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def is_retryable_http_error(exc):
+    status = get_http_status(exc)
+    return status is not None and (status == 409 or status >= 500)
+
+
+def call_with_retries(func, *args, retries=5, backoff_seconds=1,
+                      max_backoff_seconds=60, rate_limiter=None, **kwargs):
+    """
+    Call func, retrying with exponential backoff and jitter on conflicts
+    and server-side errors. Other errors are raised immediately.
+    """
+    delays = waiter.backoff_delays(backoff_seconds, max_backoff_seconds)
+    for attempt in itertools.count():
+        if rate_limiter:
+            rate_limiter.wait()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= retries or not is_retryable_http_error(e):
+                raise
+            time.sleep(next(delays))
 
 
 def get_local_rev(path):
@@ -213,6 +534,21 @@ def send_notification_mail(relay, from_email, to_emails, image):
     server.quit()
 
 
+def send_digest_mail(relay, from_email, to_emails, images):
+    templ = Environment().from_string(DIGEST_EMAIL_TEMPLATE)
+    html = templ.render(images=images)
+
+    msg = MIMEMultipart("alternative")
+    msg["From"] = from_email
+    msg["Subject"] = f"{len(images)} new Chameleon images have been released"
+    msg["To"] = ",".join(to_emails)
+    msg.attach(MIMEText(html, "html"))
+
+    server = smtplib.SMTP(relay, timeout=30)
+    server.sendmail(from_email, to_emails, msg.as_string())
+    server.quit()
+
+
 def connect_to_swift_with_admin(session, region_name):
     swift_connection = swift_conn(
         session=session,
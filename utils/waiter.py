@@ -0,0 +1,92 @@
+'''
+Polling with exponential backoff and jitter, shared by the build and test
+tools in place of fixed sleeps.
+'''
+import logging
+import random
+import time
+
+
+class TerminalStateError(RuntimeError):
+    pass
+
+
+def backoff_delays(initial=1, maximum=30, factor=2, jitter=0.5):
+    """
+    Yield an endless sequence of exponentially growing delays, each
+    shortened by up to ``jitter`` of itself so pollers do not align.
+    """
+    delay = initial
+    while True:
+        yield random.uniform(delay * (1 - jitter), delay)
+        delay = min(maximum, delay * factor)
+
+
+class Waiter:
+    """
+    Wait on many resources in a single poll loop.
+
+    Each resource is registered with a poll function returning its current
+    state, the states that mean it is ready, the states that mean it never
+    will be, and its own timeout. Exceptions raised while polling are
+    logged and retried until the resource's deadline.
+    """
+
+    def __init__(self, initial_delay=1, max_delay=30):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self._resources = {}
+
+    def add(self, name, poll, done_states, failed_states=(), timeout=(60 * 20)):
+        now = time.monotonic()
+        self._resources[name] = {
+            "poll": poll,
+            "done_states": set(done_states),
+            "failed_states": set(failed_states),
+            "deadline": now + timeout,
+            "delays": backoff_delays(self.initial_delay, self.max_delay),
+            "next_poll": now,
+        }
+
+    def wait(self):
+        """
+        Poll until every resource is ready and return their final states.
+        Raises TerminalStateError or TimeoutError for the first resource
+        that fails.
+        """
+        pending = dict(self._resources)
+        states = {}
+        while pending:
+            now = time.monotonic()
+            for name, resource in list(pending.items()):
+                if resource["next_poll"] > now:
+                    continue
+                try:
+                    state = resource["poll"]()
+                except Exception as e:
+                    logging.debug(f"Polling {name} failed: {e}")
+                    state = None
+                if state in resource["done_states"]:
+                    states[name] = state
+                    del pending[name]
+                    continue
+                if state in resource["failed_states"]:
+                    raise TerminalStateError(f"{name} is in state {state}")
+                if time.monotonic() >= resource["deadline"]:
+                    raise TimeoutError(
+                        f"Waited too long for {name} (last state {state})"
+                    )
+                resource["next_poll"] = min(
+                    time.monotonic() + next(resource["delays"]),
+                    resource["deadline"],
+                )
+            if pending:
+                next_poll = min(r["next_poll"] for r in pending.values())
+                time.sleep(max(0, next_poll - time.monotonic()))
+        return states
+
+
+def wait_for(name, poll, done_states, failed_states=(), timeout=(60 * 20), **kwargs):
+    waiter = Waiter(**kwargs)
+    waiter.add(name, poll, done_states, failed_states, timeout)
+    return waiter.wait()[name]
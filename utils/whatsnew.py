@@ -1,36 +1,161 @@
+'''
+Find the newest upstream base image revision of each supported release.
+
+Upstream pages are fetched with one shared session and conditional GETs:
+the revision found on a page is cached on disk with the page's ETag and
+Last-Modified, so an unchanged page costs a 304 and no parsing.
+'''
+from concurrent.futures import ThreadPoolExecutor
 from html.parser import HTMLParser
-import operator
+import hashlib
+import json
+import os
 import re
 import requests
-import yaml
+from requests.adapters import HTTPAdapter
 
+from utils import catalog
 
-class TableParser(HTMLParser):
-    def __init__(self):
+
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.cache/abracadabra/whatsnew")
+REQUEST_TIMEOUT = 60
+# Apache directory index sorted by last modified, newest first
+NEWEST_FIRST = "?C=M;O=D"
+
+
+class LatestFileParser(HTMLParser):
+    """
+    Finds the newest file in an Apache directory index table whose name
+    matches pattern. Fed an index sorted newest first, it is done at the
+    first row after the newest match. If the rows turn out not to be in
+    that order, every row has to be compared instead.
+    """
+    last_modified_pattern = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2})$')
+
+    def __init__(self, pattern):
         HTMLParser.__init__(self)
-        self.in_td = False
-        self.content_list = []
+        self.pattern = re.compile(pattern)
+        self.file_name = None
+        self.last_modified = None
+        self.newest_first = True
+        self.done = False
+        self._previous_date = None
+        self._row = None
+        self._in_td = False
 
     def handle_starttag(self, tag, attrs):
-        if tag == 'td':
-            self.in_td = True
+        if tag == 'tr':
+            self._row = []
+        elif tag == 'td' and self._row is not None:
+            self._in_td = True
+            self._row.append("")
 
     def handle_data(self, data):
-        if self.in_td:
-            self.content_list.append(data.strip())
+        if self._in_td:
+            self._row[-1] += data
 
     def handle_endtag(self, tag):
-        self.in_td = False
+        if tag == 'td':
+            self._in_td = False
+        elif tag == 'tr' and self._row is not None:
+            self._end_row([cell.strip() for cell in self._row])
+            self._row = None
+
+    def _end_row(self, cells):
+        date = next((c for c in cells if self.last_modified_pattern.match(c)), None)
+        if date is None:
+            return
+        # dates compare chronologically as strings
+        if self._previous_date is not None and date > self._previous_date:
+            self.newest_first = False
+        self._previous_date = date
+
+        if self.file_name and self.newest_first:
+            # a row after the match, and still newest first
+            self.done = True
+            return
+        name = next((c for c in cells if self.pattern.match(c)), None)
+        if name and (self.last_modified is None or date > self.last_modified):
+            self.file_name = name
+            self.last_modified = date
+
+
+def make_session(concurrency=8):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 class Newest:
-    def _get_releases(self, distro):
-        with open("../supports.yaml", 'r') as f:
-            supports = yaml.safe_load(f)
-
-        releases = supports["supported_distros"][distro]["releases"]
+    def __init__(self, session=None, cache_dir=DEFAULT_CACHE_DIR):
+        self.session = session or make_session()
+        # None disables the on-disk cache
+        self.cache_dir = cache_dir
 
-        return releases
+    def _get_releases(self, distro):
+        return catalog.load().distros[distro]["releases"]
+
+    def _cache_path(self, url, parser):
+        key = f"{parser}\n{url}"
+        return os.path.join(
+            self.cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".json"
+        )
+
+    def _read_cache(self, url, parser):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(url, parser), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, url, parser, etag, last_modified, result):
+        if not self.cache_dir or not (etag or last_modified) or result is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._cache_path(url, parser)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "url": url,
+                "parser": parser,
+                "etag": etag,
+                "last_modified": last_modified,
+                "result": result,
+            }, f)
+        os.replace(tmp_path, path)
+
+    def _fetch(self, url, parse, parser):
+        """
+        Return parse(response) for a streamed GET of url, or the result
+        cached for url when the server answers 304 Not Modified. parser
+        names what parse looks for, e.g. its file name pattern, so results
+        cached for the same url by different parsers are kept apart.
+        """
+        cached = self._read_cache(url, parser)
+        headers = {}
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        with self.session.get(url, headers=headers, stream=True,
+                              timeout=REQUEST_TIMEOUT) as response:
+            if response.status_code == 304 and cached:
+                return cached["result"]
+            response.raise_for_status()
+            if response.encoding is None:
+                response.encoding = "utf-8"
+            result = parse(response)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+
+        self._write_cache(url, parser, etag, last_modified, result)
+        return result
 
     def centos(self, release):
         support_centos = self._get_releases("centos")
@@ -39,58 +164,64 @@ class Newest:
         path = release_spec["base_image_path"]
         genericcloud_file_pattern = release_spec["genericcloud_file_pattern"]
 
-        p = TableParser()
-        p.feed(requests.get(path).text)
-
-        last_modified_pattern = r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2})$'
-        image_date_dict = {}
-        current_file = None
-
-        for content in p.content_list:
-            if re.match(genericcloud_file_pattern, content):
-                image_date_dict[content] = None
-                current_file = content
-            elif re.match(last_modified_pattern, content) and current_file:
-                image_date_dict[current_file] = content
-            else:
-                current_file = None
-
-        latest_file_name = max(image_date_dict.items(),
-                               key=operator.itemgetter(1))[0]
-
-        m = re.search(genericcloud_file_pattern, latest_file_name)
-        if m:
+        url = path + NEWEST_FIRST
+
+        def parse(response):
+            p = LatestFileParser(genericcloud_file_pattern)
+            for chunk in response.iter_content(chunk_size=16 * 1024,
+                                               decode_unicode=True):
+                p.feed(chunk)
+                if p.done:
+                    break
+            if not p.file_name:
+                raise RuntimeError(
+                    f"no file matching {genericcloud_file_pattern} in {url}"
+                )
+            m = re.search(genericcloud_file_pattern, p.file_name)
             return {'revision': m.group(1)}
 
-        return None
+        return self._fetch(url, parse, f"centos {genericcloud_file_pattern}")
 
     def ubuntu(self, release):
         support_ubuntu = self._get_releases("ubuntu")
         release_spec = support_ubuntu[release]
 
         path = release_spec["base_image_path"]
-        revision = 'unknown'
-        response = requests.get(
-            '{}/{}/current/unpacked/build-info.txt'.format(path, release))
-        response.raise_for_status()
-        for line in response.text.splitlines():
-            if line.startswith('serial='):
-                revision = line.split('=', 1)[1].strip()
 
-        return {'revision': revision}
+        def parse(response):
+            revision = 'unknown'
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith('serial='):
+                    revision = line.split('=', 1)[1].strip()
+            return {'revision': revision}
+
+        return self._fetch(
+            '{}/{}/current/unpacked/build-info.txt'.format(path, release), parse,
+            "ubuntu serial")
 
     def ipa_debian(self, release):
         support_ipa_debian = self._get_releases("ipa_debian")
         release_spec = support_ipa_debian[release]
 
         path = release_spec["base_image_path"]
-        revision = 'unknown'
-        response = requests.get(
-            '{}/{}/Release'.format(path, release))
-        response.raise_for_status()
-        for line in response.text.splitlines():
-            if line.startswith('Version:'):
-                revision = line.split(':', 1)[1].strip()
-                break
-
-        return {'revision': revision}
+
+        def parse(response):
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith('Version:'):
+                    return {'revision': line.split(':', 1)[1].strip()}
+            return {'revision': 'unknown'}
+
+        return self._fetch(
+            '{}/{}/Release'.format(path, release), parse, "debian version")
+
+    def revisions(self, releases, concurrency=8):
+        """
+        Look up every (distro, release) at once. Returns a dict of
+        (distro, release) -> the result of that distro's lookup.
+        """
+        releases = list(dict.fromkeys(releases))
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            results = executor.map(
+                lambda r: getattr(self, r[0])(r[1]), releases
+            )
+            return dict(zip(releases, results))